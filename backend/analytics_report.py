@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Offline cross-store analytics report.
+
+Usage:
+    python analytics_report.py [--batch-size N] [--top N] [--keep N]
+
+Streams every coupon (live and archived) in projected batches, folds each batch into
+per-store running totals with pandas/NumPy, and writes the result to the reports
+collection. Memory is bounded by the batch size plus one row per store, not by the
+number of coupons. Reads MONGO_URL and DB_NAME from the environment / backend/.env.
+"""
+
+import argparse
+import asyncio
+import sys
+import uuid
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from server import client, db
+
+# Time-to-redeem histogram edges in hours. Fixed edges keep the per-batch histograms additive.
+TIME_TO_REDEEM_EDGES = np.array([0, 0.25, 1, 6, 24, 72, 168, 720, np.inf])
+COUNT_COLUMNS = ["total", "shared", "redeemed", "shared_redeemed", "ttr_hours_sum", "ttr_count"]
+FIELDS = ["shopkeeper_id", "is_redeemed", "share_clicked", "click_count", "created_at", "redeemed_at"]
+
+
+def summarize_batch(docs: list):
+    """Per-store partial sums and a time-to-redeem histogram for one batch of coupons"""
+    frame = pd.DataFrame(docs, columns=FIELDS)
+    redeemed = frame["is_redeemed"].fillna(False).astype(bool).to_numpy()
+    # Anonymous coupons record a WhatsApp share, logged-in ones count Copy Link clicks
+    shared = (frame["share_clicked"].fillna(False).astype(bool).to_numpy()
+              | (frame["click_count"].fillna(0).to_numpy() > 0))
+
+    created = pd.to_datetime(frame["created_at"], utc=True, format="ISO8601", errors="coerce")
+    redeemed_at = pd.to_datetime(frame["redeemed_at"], utc=True, format="ISO8601", errors="coerce")
+    ttr_hours = ((redeemed_at - created).dt.total_seconds() / 3600).to_numpy()
+    has_ttr = redeemed & ~np.isnan(ttr_hours)
+
+    partial = pd.DataFrame({
+        "shopkeeper_id": frame["shopkeeper_id"].to_numpy(),
+        "total": 1,
+        "shared": shared.astype(np.int64),
+        "redeemed": redeemed.astype(np.int64),
+        "shared_redeemed": (shared & redeemed).astype(np.int64),
+        "ttr_hours_sum": np.where(has_ttr, ttr_hours, 0.0),
+        "ttr_count": has_ttr.astype(np.int64),
+    }).groupby("shopkeeper_id").sum()
+
+    histogram, _ = np.histogram(np.clip(ttr_hours[has_ttr], 0, None), bins=TIME_TO_REDEEM_EDGES)
+    return partial, histogram
+
+
+async def collect(batch_size: int):
+    """Fold every coupon into per-store totals without holding more than one batch of documents"""
+    totals = pd.DataFrame(columns=COUNT_COLUMNS, dtype=np.float64)
+    histogram = np.zeros(len(TIME_TO_REDEEM_EDGES) - 1, dtype=np.int64)
+    scanned = 0
+
+    def fold(docs):
+        nonlocal totals, histogram
+        partial, batch_histogram = summarize_batch(docs)
+        totals = totals.add(partial, fill_value=0)
+        histogram += batch_histogram
+
+    for collection in (db.coupons, db.coupons_archive):
+        batch = []
+        projection = {"_id": 0, **{field: 1 for field in FIELDS}}
+        async for doc in collection.find({}, projection).batch_size(batch_size):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                fold(batch)
+                scanned += len(batch)
+                batch = []
+                print(f"  scanned {scanned} coupons", file=sys.stderr)
+        if batch:
+            fold(batch)
+            scanned += len(batch)
+
+    return totals, histogram, scanned
+
+
+def histogram_percentile(histogram: np.ndarray, q: float):
+    """Upper edge of the bucket containing the q-th percentile (None when nothing was redeemed)"""
+    if histogram.sum() == 0:
+        return None
+    index = int(np.searchsorted(np.cumsum(histogram), q * histogram.sum()))
+    edge = TIME_TO_REDEEM_EDGES[index + 1]
+    return None if np.isinf(edge) else float(edge)
+
+
+def build_store_rows(totals: pd.DataFrame) -> pd.DataFrame:
+    rows = totals.copy()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rows["redemption_rate"] = rows["redeemed"] / rows["total"]
+        rows["share_to_redeem_rate"] = rows["shared_redeemed"] / rows["shared"]
+        rows["mean_hours_to_redeem"] = rows["ttr_hours_sum"] / rows["ttr_count"]
+    rows = rows.replace([np.inf, -np.inf], np.nan)
+    return rows
+
+
+async def write_report(rows: pd.DataFrame, histogram: np.ndarray, scanned: int, top: int, keep: int):
+    report_id = str(uuid.uuid4())
+    generated_at = datetime.now(timezone.utc).isoformat()
+
+    def clean(value):
+        return None if pd.isna(value) else value
+
+    store_docs = [
+        {
+            "report_id": report_id,
+            "kind": "store",
+            "shopkeeper_id": shopkeeper_id,
+            "total_coupons": int(row.total),
+            "shared_coupons": int(row.shared),
+            "redeemed_coupons": int(row.redeemed),
+            "redemption_rate": clean(row.redemption_rate),
+            "share_to_redeem_rate": clean(row.share_to_redeem_rate),
+            "mean_hours_to_redeem": clean(row.mean_hours_to_redeem),
+        }
+        for shopkeeper_id, row in rows.iterrows()
+    ]
+    for start in range(0, len(store_docs), 1000):
+        await db.reports.insert_many(store_docs[start:start + 1000])
+
+    top_rows = rows.sort_values("redeemed", ascending=False).head(top)
+    profiles = await db.shopkeeper_profiles.find(
+        {"shopkeeper_id": {"$in": list(top_rows.index)}}, {"_id": 0, "shopkeeper_id": 1, "store_name": 1}
+    ).to_list(top)
+    store_names = {p['shopkeeper_id']: p.get('store_name') for p in profiles}
+
+    total = int(rows["total"].sum())
+    shared = int(rows["shared"].sum())
+    redeemed = int(rows["redeemed"].sum())
+    # Written last, so the API never serves a summary whose store rows are still being inserted
+    await db.reports.insert_one({
+        "report_id": report_id,
+        "kind": "summary",
+        "generated_at": generated_at,
+        "coupons_scanned": scanned,
+        "stores": len(rows),
+        "total_coupons": total,
+        "shared_coupons": shared,
+        "redeemed_coupons": redeemed,
+        "redemption_rate": redeemed / total if total else None,
+        "share_to_redeem_rate": int(rows["shared_redeemed"].sum()) / shared if shared else None,
+        "time_to_redeem_hours": {
+            "bucket_edges": [None if np.isinf(e) else float(e) for e in TIME_TO_REDEEM_EDGES],
+            "counts": [int(c) for c in histogram],
+            "p50": histogram_percentile(histogram, 0.5),
+            "p90": histogram_percentile(histogram, 0.9),
+        },
+        "top_stores": [
+            {
+                "shopkeeper_id": shopkeeper_id,
+                "store_name": store_names.get(shopkeeper_id),
+                "redeemed_coupons": int(row.redeemed),
+                "redemption_rate": clean(row.redemption_rate),
+            }
+            for shopkeeper_id, row in top_rows.iterrows()
+        ],
+    })
+
+    old_reports = await db.reports.find(
+        {"kind": "summary"}, {"_id": 0, "report_id": 1}
+    ).sort("generated_at", -1).skip(keep).to_list(None)
+    if old_reports:
+        await db.reports.delete_many({"report_id": {"$in": [r['report_id'] for r in old_reports]}})
+
+    return report_id
+
+
+async def run(batch_size: int, top: int, keep: int):
+    await db.reports.create_index([("kind", 1), ("generated_at", -1)])
+    await db.reports.create_index([("report_id", 1), ("shopkeeper_id", 1)])
+
+    totals, histogram, scanned = await collect(batch_size)
+    rows = build_store_rows(totals)
+    report_id = await write_report(rows, histogram, scanned, top, keep)
+    print(f"Report {report_id}: {scanned} coupons across {len(rows)} stores")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the cross-store analytics report")
+    parser.add_argument("--batch-size", type=int, default=50000, help="coupons per batch (default 50000)")
+    parser.add_argument("--top", type=int, default=10, help="number of top stores to record (default 10)")
+    parser.add_argument("--keep", type=int, default=7, help="number of reports to keep (default 7)")
+    args = parser.parse_args()
+
+    try:
+        return asyncio.run(run(args.batch_size, args.top, args.keep))
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of per-request authentication overhead.
+
+Usage:
+    python bench_auth.py [--iterations N]
+
+Compares a full HS256 decode/verify of the access token with the cached
+TokenVerifier path that get_current_user uses. Neither touches MongoDB.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "bench")
+
+import jwt
+
+from server import (
+    ALGORITHM, SECRET_KEY, HTTPAuthorizationCredentials, TokenVerifier, User,
+    get_current_user, issue_access_token, token_verifier,
+)
+
+
+def per_call_us(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark auth overhead per request")
+    parser.add_argument("--iterations", type=int, default=100000)
+    args = parser.parse_args()
+
+    user = User(username="bench", email="bench@example.com", phone="0", role="customer")
+    token = issue_access_token(user)
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+
+    full_decode = per_call_us(lambda: jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]), args.iterations)
+    cold = TokenVerifier(max_entries=1)
+    # A second token keeps evicting the first, so every decode is a cache miss
+    other = issue_access_token(User(username="other", email="o@example.com", phone="0", role="customer"))
+    cache_miss = per_call_us(lambda: (cold.decode(token), cold.decode(other)), args.iterations // 2) / 2
+    token_verifier.decode(token)
+    cache_hit = per_call_us(lambda: token_verifier.decode(token), args.iterations)
+
+    async def dependency_loop(n):
+        start = time.perf_counter()
+        for _ in range(n):
+            await get_current_user(credentials)
+        return (time.perf_counter() - start) / n * 1e6
+
+    dependency = asyncio.run(dependency_loop(args.iterations))
+
+    print(f"{'jwt.decode (old path, before the user lookup)':<48}{full_decode:>8.2f} us/request")
+    print(f"{'TokenVerifier.decode, cache miss':<48}{cache_miss:>8.2f} us/request")
+    print(f"{'TokenVerifier.decode, cache hit':<48}{cache_hit:>8.2f} us/request")
+    print(f"{'get_current_user, cached claims, no DB':<48}{dependency:>8.2f} us/request")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
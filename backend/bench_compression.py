@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Bytes on the wire and CPU cost of response compression per route.
+
+Usage:
+    python bench_compression.py [--stores 10,100,1000] [--coupons 100,1000] [--image-kb 150]
+
+Builds representative JSON bodies for the store directory, a shopkeeper's coupon list and
+a store page with its base64 promotional image, then reports the body size and the time
+to compress it with GZIP_LEVEL and BROTLI_QUALITY. Routes served from a cached Snapshot
+pay that time once per cache fill, the others on every request. Nothing touches MongoDB.
+The brotli column needs the optional brotli package.
+"""
+
+import argparse
+import base64
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "bench")
+
+import numpy as np
+
+from server import Coupon, Snapshot, brotli, compress_body
+
+
+def directory_body(stores: int) -> bytes:
+    return Snapshot([
+        {
+            "id": str(uuid.uuid4()),
+            "username": f"store{i}",
+            "store_name": f"Store number {i}",
+            "cashback_offer": f"{5 + i % 20}% cashback on orders above Rs {100 * (1 + i % 5)}",
+        }
+        for i in range(stores)
+    ]).body()
+
+
+def coupon_list_body(coupons: int) -> bytes:
+    shopkeeper_id = str(uuid.uuid4())
+    return Snapshot([
+        Coupon(customer_id=f"anonymous_{uuid.uuid4().hex[:12]}", shopkeeper_id=shopkeeper_id,
+               created_at=datetime.now(timezone.utc)).model_dump(mode="json")
+        for _ in range(coupons)
+    ]).body()
+
+
+def store_page_body(image_kb: int) -> bytes:
+    # Random bytes stand in for an already-compressed JPEG, the worst case for gzip
+    image = np.random.default_rng(0).integers(0, 256, image_kb * 1024, dtype=np.uint8).tobytes()
+    return Snapshot({
+        "store_name": "Corner Store",
+        "cashback_offer": "10% cashback",
+        "store_description": "Fresh groceries every day",
+        "promotional_image": "data:image/jpeg;base64," + base64.b64encode(image).decode(),
+    }).body()
+
+
+def measure(body: bytes, encoding: str, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        compressed = compress_body(body, encoding)
+    return len(compressed), (time.perf_counter() - start) / repeat * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark response compression per route")
+    parser.add_argument("--stores", default="10,100,1000")
+    parser.add_argument("--coupons", default="100,1000")
+    parser.add_argument("--image-kb", type=int, default=150)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    bodies = [(f"GET /public/shopkeepers ({n} stores)", directory_body(int(n))) for n in args.stores.split(",")]
+    bodies += [(f"GET /shopkeeper/coupons ({n} coupons)", coupon_list_body(int(n))) for n in args.coupons.split(",")]
+    bodies.append((f"GET /public/shopkeeper/<id> ({args.image_kb} KB image)", store_page_body(args.image_kb)))
+
+    encodings = ["gzip"] if brotli is None else ["gzip", "br"]
+    print(f"{'route':<46}{'raw bytes':>10}" + "".join(f"{encoding + ' bytes, cpu':>22}" for encoding in encodings))
+    for name, body in bodies:
+        row = f"{name:<46}{len(body):>10}"
+        for encoding in encodings:
+            size, ms = measure(body, encoding, args.repeat)
+            row += f"{size:>10} {ms:>7.2f} ms  "
+        print(row)
+    if brotli is None:
+        print("brotli not installed, only gzip measured", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Export a store's coupons (live and archived) to CSV or Parquet.
+
+Usage:
+    python export_coupons.py <shopkeeper username or id> [--format csv|parquet] [--output FILE]
+
+Reads MONGO_URL and DB_NAME from the environment / backend/.env, same as the API server.
+"""
+
+import argparse
+import asyncio
+import sys
+
+from server import client, db, stream_coupon_export, EXPORT_FORMATS
+
+
+async def export(shopkeeper: str, export_format: str, output: str):
+    user = await db.users.find_one(
+        {"role": "shopkeeper", "$or": [{"id": shopkeeper}, {"username": shopkeeper}]},
+        {"_id": 0, "id": 1}
+    )
+    if not user:
+        print(f"Shopkeeper not found: {shopkeeper}", file=sys.stderr)
+        return 1
+
+    out = sys.stdout.buffer if output == "-" else open(output, "wb")
+    try:
+        async for chunk in stream_coupon_export(user['id'], export_format):
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a store's coupons")
+    parser.add_argument("shopkeeper", help="shopkeeper username or id")
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="csv")
+    parser.add_argument("--output", default="-", help="output file, - for stdout (default)")
+    args = parser.parse_args()
+
+    try:
+        return asyncio.run(export(args.shopkeeper, args.format, args.output))
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
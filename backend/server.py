@@ -1,18 +1,38 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form, Request, Header, Query
+from fastapi.responses import StreamingResponse, JSONResponse, HTMLResponse, Response
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers, MutableHeaders
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, ReplaceOne, UpdateOne
+from pymongo.errors import DuplicateKeyError, ConnectionFailure, ExecutionTimeout, WTimeoutError
+import pymongo
+from pymongo import _csot, monitoring
+from pymongo.read_preferences import Nearest, PrimaryPreferred, Secondary, SecondaryPreferred
 import os
+import asyncio
+import contextvars
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
 from typing import List, Optional
 import uuid
+import math
+import time
 from datetime import datetime, timezone, timedelta
 from passlib.context import CryptContext
 import jwt
 import base64
+from collections import deque
+import io
+import zlib
+import html
+import hashlib
+import ipaddress
+from urllib.parse import quote
+import pandas as pd
 
 
 ROOT_DIR = Path(__file__).parent
@@ -23,13 +43,32 @@ import certifi
 
 mongo_url = os.environ['MONGO_URL']
 
+# Set by guard_database for each API request. Motor runs commands in a copy of the caller's
+# context, so the listener marks a shared dict rather than setting the variable itself.
+request_mongo_usage = contextvars.ContextVar("request_mongo_usage", default=None)
+
+class MongoUsageListener(monitoring.CommandListener):
+    """Records that the current request actually sent a command, as opposed to being served from cache"""
+
+    def started(self, event):
+        usage = request_mongo_usage.get()
+        if usage is not None:
+            usage["reached"] = True
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
 # Only use SSL for remote MongoDB connections
 if 'localhost' in mongo_url or '127.0.0.1' in mongo_url:
     # Local MongoDB without SSL
     client = AsyncIOMotorClient(
         mongo_url,
         serverSelectionTimeoutMS=5000,
-        connectTimeoutMS=10000
+        connectTimeoutMS=10000,
+        event_listeners=[MongoUsageListener()]
     )
 else:
     # Remote MongoDB with SSL
@@ -37,13 +76,33 @@ else:
         mongo_url,
         tlsCAFile=certifi.where(),
         serverSelectionTimeoutMS=5000,
-        connectTimeoutMS=10000
+        connectTimeoutMS=10000,
+        event_listeners=[MongoUsageListener()]
     )
 db = client[os.environ['DB_NAME']]
 
+# Public, read-only pages (shared coupon links, store pages, the store directory) can
+# show data a little behind the primary, so they read through public_db. Anything that
+# must read its own writes (auth, clicks, redeem, dashboards) keeps using db.
+READ_PREFERENCES = {
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+PUBLIC_READ_PREFERENCE = os.environ.get('PUBLIC_READ_PREFERENCE', 'secondaryPreferred')
+PUBLIC_READ_MAX_STALENESS_SECONDS = int(os.environ.get('PUBLIC_READ_MAX_STALENESS_SECONDS', '90'))
+if PUBLIC_READ_PREFERENCE == 'primary':
+    public_db = db
+else:
+    public_db = db.with_options(read_preference=READ_PREFERENCES[PUBLIC_READ_PREFERENCE](
+        max_staleness=PUBLIC_READ_MAX_STALENESS_SECONDS
+    ))
+
 # Security
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 SECRET_KEY = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
 ALGORITHM = "HS256"
 
@@ -75,6 +134,12 @@ class User(UserBase):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class CurrentUser(BaseModel):
+    """Authenticated caller as described by the access token claims"""
+    id: str
+    username: str
+    role: str
+
 class LoginRequest(BaseModel):
     username: str
     password: str
@@ -117,6 +182,13 @@ class CouponCreate(BaseModel):
 class ClickTrackRequest(BaseModel):
     coupon_code: str
 
+class BatchOperation(BaseModel):
+    op: str  # 'coupon', 'share' or 'click'
+    coupon_code: str
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation] = Field(..., min_length=1, max_length=50)
+
 
 # ============ UTILITY FUNCTIONS ============
 
@@ -131,35 +203,1815 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     if expires_delta:
         expire = datetime.now(timezone.utc) + expires_delta
     else:
-        expire = datetime.now(timezone.utc) + timedelta(days=30)  # 30 days for session persistence
+        expire = datetime.now(timezone.utc) + ACCESS_TOKEN_LIFETIME
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> User:
+ACCESS_TOKEN_LIFETIME = timedelta(days=30)  # 30 days for session persistence
+TOKEN_VERSION_REFRESH_SECONDS = float(os.environ.get('TOKEN_VERSION_REFRESH_SECONDS', '30'))
+
+def issue_access_token(user: User, token_version: int = 0) -> str:
+    # role and username ride in the token so most requests never need to load the user
+    return create_access_token(data={
+        "sub": user.id,
+        "role": user.role,
+        "username": user.username,
+        "ver": token_version,
+    })
+
+class TokenVerifier:
+    """Remembers verified tokens so repeat requests skip the HMAC check.
+
+    Revocation is a version check against an in-memory map of users whose tokens were
+    revoked (or who were deleted), refreshed in the background rather than per request.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self.verified = {}
+        self.min_versions = {}
+
+    def decode(self, token: str) -> dict:
+        claims = self.verified.get(token)
+        if claims is None:
+            claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            if len(self.verified) >= self.max_entries:
+                self.verified.pop(next(iter(self.verified)))
+            self.verified[token] = claims
+        elif claims.get("exp", 0) < time.time():
+            self.verified.pop(token, None)
+            raise jwt.ExpiredSignatureError("Signature has expired")
+        return claims
+
+    def is_revoked(self, claims: dict) -> bool:
+        min_version = self.min_versions.get(claims.get("sub"))
+        return min_version is not None and claims.get("ver", 0) < min_version
+
+    def revoke(self, user_id: str, min_version: float):
+        self.min_versions[user_id] = min_version
+
+    async def refresh(self):
+        min_versions = {}
+        async for user in db.users.find(
+            {"$or": [{"token_version": {"$gt": 0}}, {"deleted_at": {"$exists": True}}]},
+            {"_id": 0, "id": 1, "token_version": 1, "deleted_at": 1}
+        ):
+            min_versions[user['id']] = math.inf if user.get('deleted_at') else user['token_version']
+        # Users whose documents are already gone, kept until their last token would have expired
+        async for tombstone in db.revoked_users.find({}, {"_id": 0, "id": 1}):
+            min_versions[tombstone['id']] = math.inf
+        # Versions only ever go up, so keep anything newer revoked locally while this query ran
+        for user_id, version in self.min_versions.items():
+            if version > min_versions.get(user_id, 0):
+                min_versions[user_id] = version
+        self.min_versions = min_versions
+
+    async def refresher(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Token version refresh failed")
+            await asyncio.sleep(TOKEN_VERSION_REFRESH_SECONDS)
+
+token_verifier = TokenVerifier()
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> CurrentUser:
     try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
-        
-        user_doc = await db.users.find_one({"id": user_id}, {"_id": 0})
-        if user_doc is None:
-            raise HTTPException(status_code=401, detail="User not found")
-        
-        if isinstance(user_doc['created_at'], str):
-            user_doc['created_at'] = datetime.fromisoformat(user_doc['created_at'])
-        
-        return User(**user_doc)
+        claims = token_verifier.decode(credentials.credentials)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token has expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Could not validate credentials")
+    
+    user_id: str = claims.get("sub")
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    
+    if token_verifier.is_revoked(claims):
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    
+    if "role" in claims and "username" in claims:
+        return CurrentUser(id=user_id, username=claims["username"], role=claims["role"])
+    
+    # Tokens issued before role/username were embedded still need the user document
+    user_doc = await find_user(user_id)
+    if user_doc is None or user_doc.get('deleted_at'):
+        raise HTTPException(status_code=401, detail="User not found")
+    
+    return CurrentUser(id=user_id, username=user_doc['username'], role=user_doc['role'])
+
+async def get_current_user_record(current_user: CurrentUser = Depends(get_current_user)) -> User:
+    """Full user document, for the few routes that need more than the token claims"""
+    user_doc = await find_user(current_user.id)
+    if user_doc is None or user_doc.get('deleted_at'):
+        raise HTTPException(status_code=401, detail="User not found")
+    
+    created_at = user_doc['created_at']
+    if isinstance(created_at, str):
+        created_at = datetime.fromisoformat(created_at)
+    
+    return User(**{**user_doc, "created_at": created_at})
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into one in-flight coroutine.
+
+    Every caller gets the same result object, so callers must not mutate it.
+    """
+
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, fn):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self.calls[key] = task
+            task.add_done_callback(lambda t: self.calls.pop(key, None) if self.calls.get(key) is t else None)
+        # Shielded so one caller disconnecting doesn't cancel the work for everyone else
+        return await asyncio.shield(task)
+
+# Concurrent identical reads share one Motor query, so a viral store link costs
+# one find_one per distinct key instead of one per request
+read_flight = SingleFlight()
+
+def flight_key(collection: str, query: dict, projection: Optional[dict] = None):
+    return (collection, repr(sorted(query.items())), repr(sorted(projection.items())) if projection else None)
+
+async def find_profile(shopkeeper_id: str, public: bool = False):
+    """Shared, read-only shopkeeper profile lookup. public=True reads through public_db."""
+    stale = public and public_db is not db
+
+    async def lookup():
+        generation = profile_cache.generation
+        source = public_db if stale else db
+        profile = await source.shopkeeper_profiles.find_one({"shopkeeper_id": shopkeeper_id}, {"_id": 0})
+        if profile is None and source is not db:
+            # Possibly a store that signed up after the secondary's last sync
+            source = db
+            profile = await source.shopkeeper_profiles.find_one({"shopkeeper_id": shopkeeper_id}, {"_id": 0})
+        profile_cache.set(shopkeeper_id, profile, generation, stale=source is not db)
+        return profile
+
+    profile = profile_cache.get(shopkeeper_id, stale_ok=stale)
+    if profile is not CACHE_MISS:
+        return profile
+    return await read_flight.do(("shopkeeper_profiles", shopkeeper_id, stale), lookup)
+
+async def find_profiles(shopkeeper_ids) -> dict:
+    """Profiles for many stores, served from the cache where possible and one $in query otherwise"""
+    profiles = {}
+    missing = []
+    for shopkeeper_id in set(shopkeeper_ids):
+        profile = profile_cache.get(shopkeeper_id, stale_ok=False)
+        if profile is CACHE_MISS:
+            missing.append(shopkeeper_id)
+        else:
+            profiles[shopkeeper_id] = profile
+    if missing:
+        generation = profile_cache.generation
+        found = {
+            p['shopkeeper_id']: p
+            for p in await db.shopkeeper_profiles.find(
+                {"shopkeeper_id": {"$in": missing}}, {"_id": 0}
+            ).to_list(len(missing))
+        }
+        for shopkeeper_id in missing:
+            profile_cache.set(shopkeeper_id, found.get(shopkeeper_id), generation)
+            profiles[shopkeeper_id] = found.get(shopkeeper_id)
+    return profiles
+
+async def find_user(user_id: str):
+    """Shared, read-only user lookup used by authentication"""
+    async def lookup():
+        generation = user_cache.generation
+        user_doc = await db.users.find_one({"id": user_id}, {"_id": 0})
+        user_cache.set(user_id, user_doc, generation)
+        return user_doc
+
+    user_doc = user_cache.get(user_id)
+    if user_doc is not CACHE_MISS:
+        return user_doc
+    return await read_flight.do(("users", user_id), lookup)
+
+
+# ============ CACHING ============
+
+# With the change stream running, cached entries are invalidated as soon as any worker
+# writes, so they can live long. Without it (standalone Mongo) they fall back to a short TTL.
+CACHE_TTL_SECONDS = float(os.environ.get('CACHE_TTL_SECONDS', '600'))
+CACHE_FALLBACK_TTL_SECONDS = float(os.environ.get('CACHE_FALLBACK_TTL_SECONDS', '5'))
+# Entries read from a secondary can't rely on invalidation alone, so they expire after the
+# same bound the secondary itself is held to
+STALE_CACHE_TTL_SECONDS = PUBLIC_READ_MAX_STALENESS_SECONDS if PUBLIC_READ_MAX_STALENESS_SECONDS > 0 else CACHE_FALLBACK_TTL_SECONDS
+
+# Per-cache memory budget. Store pages and profiles carry base64 images of a few hundred KB,
+# so a count alone doesn't bound memory
+CACHE_MAX_BYTES = int(float(os.environ.get('CACHE_MAX_MB', '16')) * 1024 * 1024)
+
+CACHE_MISS = object()
+
+def approximate_size(value) -> int:
+    """Rough bytes held by a cached value, dominated by base64 images and serialized bodies"""
+    nbytes = getattr(value, "nbytes", None)
+    if nbytes is not None:
+        return nbytes
+    if isinstance(value, (str, bytes)):
+        return 50 + len(value)
+    if isinstance(value, dict):
+        return 200 + sum(approximate_size(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return 60 + sum(approximate_size(v) for v in value)
+    return 32
+
+class TTLCache:
+    """Small per-process cache of read-only documents. Values are shared, never mutate them."""
+
+    def __init__(self, name: str, max_entries: int = 10000, ttl_seconds: Optional[float] = None,
+                 max_bytes: int = CACHE_MAX_BYTES):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        # key -> (value, stored_at, stale, size)
+        self.entries = {}
+        self.bytes = 0
+        # Values that expired or were invalidated, kept for degraded mode when Mongo is down.
+        # key -> (value, size), oldest first, held to the same count and byte budget as entries
+        self.retired = {}
+        self.retired_bytes = 0
+        # Bumped on every invalidation so a read that raced with a write can't cache the stale value
+        self.generation = 0
+
+    def ttl(self) -> float:
+        if self.ttl_seconds is not None:
+            return self.ttl_seconds
+        return CACHE_TTL_SECONDS if cache_invalidator.live else CACHE_FALLBACK_TTL_SECONDS
+
+    def get(self, key, stale_ok: bool = True):
+        """stale_ok=False skips entries read from a secondary, for callers that must see their own writes"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return CACHE_MISS
+        value, stored_at, stale, _ = entry
+        if stale and not stale_ok:
+            return CACHE_MISS
+        ttl = min(self.ttl(), STALE_CACHE_TTL_SECONDS) if stale else self.ttl()
+        if time.monotonic() - stored_at > ttl:
+            self.retire(key)
+            return CACHE_MISS
+        return value
+
+    def last_known(self, key):
+        """The most recent value for key, however old. Only for serving while Mongo is unavailable."""
+        entry = self.entries.get(key)
+        if entry is not None:
+            return entry[0]
+        retired = self.retired.get(key)
+        return retired[0] if retired is not None else None
+
+    def retire(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= entry[3]
+        if entry[0] is None:
+            return
+        self.drop_retired(key)
+        size = entry[3]
+        while self.retired and (len(self.retired) >= self.max_entries or self.retired_bytes + size > self.max_bytes):
+            self.drop_retired(next(iter(self.retired)))
+        self.retired[key] = (entry[0], size)
+        self.retired_bytes += size
+
+    def drop_retired(self, key):
+        retired = self.retired.pop(key, None)
+        if retired is not None:
+            self.retired_bytes -= retired[1]
+
+    def set(self, key, value, generation: Optional[int] = None, stale: bool = False):
+        """stale marks a value read from a secondary. It may predate the invalidation that
+        emptied this slot, so it's only kept for STALE_CACHE_TTL_SECONDS."""
+        if generation is not None and generation != self.generation:
+            return
+        size = approximate_size(value)
+        if size > self.max_bytes:
+            return
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.bytes -= previous[3]
+        # Oldest first: dicts keep insertion order and a refreshed key is re-inserted at the end
+        while self.entries and (len(self.entries) >= self.max_entries or self.bytes + size > self.max_bytes):
+            self.retire(next(iter(self.entries)))
+        self.entries[key] = (value, time.monotonic(), stale, size)
+        self.bytes += size
+
+    def invalidate(self, key):
+        self.generation += 1
+        self.retire(key)
+
+    def clear(self):
+        self.generation += 1
+        for key in list(self.entries):
+            self.retire(key)
+
+# Change-stream getMores wait this long for events, so an idle stream still reports in
+CHANGE_STREAM_AWAIT_MS = 1000
+# Behind by more than this (events queued faster than this worker handles them), the stream
+# isn't trusted to have delivered recent inserts, e.g. by the coupon code filter
+CHANGE_STREAM_MAX_LAG_SECONDS = float(os.environ.get('CHANGE_STREAM_MAX_LAG_SECONDS', '3'))
+
+class CacheInvalidator:
+    """Fans Mongo change events out to the local caches subscribed to each collection"""
+
+    def __init__(self):
+        self.subscriptions = {}
+        self.watchers = {}
+        self.live = False
+        # Bumped every time the stream (re)opens, events from before may have been missed
+        self.epoch = 0
+        self.resume_token = None
+        # Unix time up to which every change has been handled: an event's server time, or now
+        # when a getMore comes back empty
+        self.synced_at = 0.0
+
+    def subscribe(self, collection: str, cache: TTLCache, key_field: Optional[str] = None,
+                  clear_on_delete: bool = True):
+        """key_field picks the cache key out of the changed document; None clears the whole cache.
+
+        Delete events only carry _id, so they clear the cache unless clear_on_delete is False,
+        for caches whose entries may outlive their document until the TTL.
+        """
+        self.subscriptions.setdefault(collection, []).append((cache, key_field, clear_on_delete))
+
+    def watch(self, collection: str, callback):
+        """callback(document) for every change to collection that carries a document"""
+        self.watchers.setdefault(collection, []).append(callback)
+
+    def publish(self, collection: str, document: Optional[dict], deleted: bool = False):
+        if document:
+            for callback in self.watchers.get(collection, []):
+                callback(document)
+        for cache, key_field, clear_on_delete in self.subscriptions.get(collection, []):
+            if key_field and document and document.get(key_field) is not None:
+                cache.invalidate(document[key_field])
+            elif clear_on_delete or not deleted:
+                cache.clear()
+
+    def caught_up(self) -> bool:
+        """True while the stream is live and no change older than CHANGE_STREAM_MAX_LAG_SECONDS is pending"""
+        return self.live and time.time() - self.synced_at <= CHANGE_STREAM_MAX_LAG_SECONDS
+
+    def clear_all(self):
+        for subscribers in self.subscriptions.values():
+            for cache, _, _ in subscribers:
+                cache.clear()
+
+    async def listen(self):
+        pipeline = [
+            {"$match": {"ns.coll": {"$in": list(set(self.subscriptions) | set(self.watchers))}}},
+            # Only the cache keys are needed, not whole documents with their base64 images
+            {"$project": {
+                "operationType": 1, "ns": 1, "clusterTime": 1, "wallTime": 1,
+                "fullDocument.id": 1, "fullDocument.shopkeeper_id": 1, "fullDocument.coupon_code": 1,
+            }},
+        ]
+        delay = 1
+        while True:
+            opened = False
+            try:
+                async with db.watch(pipeline, full_document="updateLookup", resume_after=self.resume_token,
+                                    max_await_time_ms=CHANGE_STREAM_AWAIT_MS) as stream:
+                    opened = True
+                    self.live = True
+                    self.epoch += 1
+                    delay = 1
+                    while stream.alive:
+                        change = await stream.try_next()
+                        self.resume_token = stream.resume_token
+                        if change is None:
+                            # An empty batch, nothing is waiting to be handled
+                            self.synced_at = time.time()
+                            continue
+                        # wallTime needs MongoDB 6.0, clusterTime only has second precision
+                        wall_time = change.get("wallTime")
+                        if wall_time is not None:
+                            self.synced_at = wall_time.replace(tzinfo=timezone.utc).timestamp()
+                        elif change.get("clusterTime") is not None:
+                            self.synced_at = change["clusterTime"].time
+                        self.publish(change["ns"]["coll"], change.get("fullDocument"),
+                                     deleted=change["operationType"] == "delete")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self.live:
+                    logger.warning(f"Cache invalidation change stream stopped: {e}")
+                else:
+                    logger.info(f"Change streams unavailable, caches use a {CACHE_FALLBACK_TTL_SECONDS}s TTL: {e}")
+                self.live = False
+                # Events may have been missed while disconnected
+                self.clear_all()
+                if not opened:
+                    # The resume token itself may be the problem (e.g. fell off the oplog)
+                    self.resume_token = None
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+
+cache_invalidator = CacheInvalidator()
+profile_cache = TTLCache("shopkeeper_profiles")
+user_cache = TTLCache("users")
+directory_cache = TTLCache("directory", max_entries=1)
+public_coupon_cache = TTLCache("public_coupons")
+shopkeeper_info_cache = TTLCache("shopkeeper_info", max_entries=1000)
+
+cache_invalidator.subscribe("shopkeeper_profiles", profile_cache, "shopkeeper_id")
+cache_invalidator.subscribe("shopkeeper_profiles", directory_cache)
+cache_invalidator.subscribe("shopkeeper_profiles", shopkeeper_info_cache, "shopkeeper_id")
+cache_invalidator.subscribe("users", user_cache, "id")
+cache_invalidator.subscribe("users", directory_cache)
+# Coupons are deleted in bulk by the TTL index, the sweeper and store deletions. A deleted coupon's
+# page may stay cached until the TTL: archived ones are still served from coupons_archive, expired
+# ones were never shared, and store deletions clear the cache through shopkeeper_profiles
+cache_invalidator.subscribe("coupons", public_coupon_cache, "coupon_code", clear_on_delete=False)
+
+
+# ============ COMPRESSION ============
+
+# Public JSON (store directory, coupon pages with base64 images) is mostly text and shrinks a
+# lot, which matters on slow mobile connections. Brotli is used when the optional brotli
+# package is installed and the client accepts it, gzip otherwise.
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', '1024'))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', '6'))
+# Measured with bench_compression.py: higher levels barely shrink these bodies further but
+# cost several times the CPU (brotli 10+ takes ~100 ms on a 1000-store directory)
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', '5'))
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "application/xml", "image/svg+xml")
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+def negotiate_encoding(accept_encoding: str, offered=("br", "gzip")) -> str:
+    """Best of the offered encodings that the client accepts and we can produce, or identity"""
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        token, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[token] = quality
+    for encoding in offered:
+        if encoding == "br" and brotli is None:
+            continue
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return "identity"
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress(body) + compressor.flush()
+
+class StreamCompressor:
+    """Incremental gzip/brotli for streamed bodies, flushing each chunk so the client keeps receiving data"""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        if self.encoding == "br":
+            out = self.compressor.process(data)
+            return out + (self.compressor.finish() if final else self.compressor.flush())
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+class CompressionMiddleware:
+    """Compresses text responses of at least COMPRESSION_MIN_BYTES.
+
+    Responses that already carry a Content-Encoding (precompressed snapshots) and binary
+    types such as images and Parquet are passed through untouched.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding == "identity":
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        compressor = None
+
+        async def send_compressed(message):
+            nonlocal start, compressor
+            if message["type"] == "http.response.start":
+                # Held back until the first body chunk shows whether it's worth compressing
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start is not None:
+                headers = MutableHeaders(raw=start["headers"])
+                start_message, start = start, None
+                content_type = headers.get("content-type", "")
+                if (
+                    "content-encoding" not in headers
+                    and content_type.startswith(COMPRESSIBLE_TYPES)
+                    and (more_body or len(body) >= COMPRESSION_MIN_BYTES)
+                ):
+                    compressor = StreamCompressor(encoding)
+                    headers["Content-Encoding"] = encoding
+                    headers.add_vary_header("Accept-Encoding")
+                    if "content-length" in headers:
+                        del headers["Content-Length"]
+                    body = compressor.compress(body, final=not more_body)
+                    if not more_body:
+                        headers["Content-Length"] = str(len(body))
+                    message = {**message, "body": body}
+                await send(start_message)
+                await send(message)
+                return
+            if compressor is not None:
+                message = {**message, "body": compressor.compress(body, final=not more_body)}
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+class Snapshot:
+    """A cacheable JSON response, serialized once and compressed at most once per encoding"""
+
+    __slots__ = ("encodings",)
+    offered = ("br", "gzip")
+
+    def __init__(self, value):
+        self.encodings = {"identity": JSONResponse(jsonable_encoder(value)).body}
+
+    def __len__(self) -> int:
+        return len(self.encodings["identity"])
+
+    @property
+    def nbytes(self) -> int:
+        # Compressed copies are built on demand and are no bigger than the body, so
+        # budget for the body plus one per encoding and the deflated tail
+        return len(self) * 4
+
+    def body(self, encoding: str = "identity") -> bytes:
+        body = self.encodings.get(encoding)
+        if body is None:
+            body = compress_body(self.encodings["identity"], encoding)
+            self.encodings[encoding] = body
+        return body
+
+    def deflated_tail(self) -> bytes:
+        """Raw deflate of the body after its opening brace, for PrefixedSnapshot"""
+        tail = self.encodings.get("deflate-tail")
+        if tail is None:
+            compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -15)
+            tail = compressor.compress(self.encodings["identity"][1:]) + compressor.flush()
+            self.encodings["deflate-tail"] = tail
+        return tail
+
+    def response(self, request: Request, headers: Optional[dict] = None) -> Response:
+        headers = {"Vary": "Accept-Encoding", **(headers or {})}
+        encoding = negotiate_encoding(request.headers.get("accept-encoding", ""), self.offered)
+        if encoding != "identity" and len(self) >= COMPRESSION_MIN_BYTES:
+            headers["Content-Encoding"] = encoding
+        else:
+            encoding = "identity"
+        return Response(self.body(encoding), media_type="application/json", headers=headers)
+
+class PrefixedSnapshot(Snapshot):
+    """A few per-response fields in front of a shared Snapshot of a JSON object.
+
+    Only the fields are encoded per response. gzip splices their deflate output onto the
+    snapshot's precompressed tail, which brotli can't do, so gzip is the only encoding offered.
+    """
+
+    __slots__ = ("prefix", "snapshot")
+    offered = ("gzip",)
+
+    def __init__(self, fields: dict, snapshot: Snapshot):
+        self.prefix = JSONResponse(jsonable_encoder(fields)).body[:-1] + b","
+        self.snapshot = snapshot
+
+    def __len__(self) -> int:
+        return len(self.prefix) + len(self.snapshot) - 1
+
+    def body(self, encoding: str = "identity") -> bytes:
+        tail = self.snapshot.body()[1:]
+        if encoding == "identity":
+            return self.prefix + tail
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -15)
+        # A sync flush byte-aligns the prefix without ending the stream; the tail was deflated
+        # on its own, so it never refers back to the prefix
+        head = compressor.compress(self.prefix) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        crc = zlib.crc32(tail, zlib.crc32(self.prefix))
+        size = (len(self.prefix) + len(tail)) & 0xffffffff
+        return GZIP_HEADER + head + self.snapshot.deflated_tail() + crc.to_bytes(4, "little") + size.to_bytes(4, "little")
+
+
+# ============ CIRCUIT BREAKER ============
+
+# Every /api request gets a deadline for all of its Mongo calls, so a slow database turns
+# into fast errors instead of requests piling up behind serverSelectionTimeoutMS
+MONGO_READ_TIMEOUT_SECONDS = float(os.environ.get('MONGO_READ_TIMEOUT_SECONDS', '2'))
+MONGO_WRITE_TIMEOUT_SECONDS = float(os.environ.get('MONGO_WRITE_TIMEOUT_SECONDS', '5'))
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', '5'))
+BREAKER_WINDOW_SECONDS = float(os.environ.get('BREAKER_WINDOW_SECONDS', '10'))
+BREAKER_RESET_SECONDS = float(os.environ.get('BREAKER_RESET_SECONDS', '15'))
+
+# Timeouts and lost connections, as opposed to errors caused by the request itself
+MONGO_UNAVAILABLE_ERRORS = (ConnectionFailure, ExecutionTimeout, WTimeoutError)
+
+class DatabaseUnavailable(Exception):
+    """Raised instead of calling Mongo while the circuit breaker is open"""
+
+class CircuitBreaker:
+    """Stops sending requests to Mongo after repeated timeouts.
+
+    closed: everything goes through. Once BREAKER_FAILURE_THRESHOLD failures land within
+    BREAKER_WINDOW_SECONDS it opens and requests are rejected without touching Mongo.
+    After BREAKER_RESET_SECONDS a single trial request is let through (half-open);
+    success closes the breaker, another failure opens it again.
+    """
+
+    def __init__(self):
+        self.state = "closed"
+        self.failures = deque()
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.times_opened = 0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= BREAKER_RESET_SECONDS:
+            self.state = "half_open"
+        if self.state == "half_open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info("MongoDB circuit breaker closed")
+        self.state = "closed"
+        self.trial_in_flight = False
+        self.failures.clear()
+
+    def release(self):
+        """The request let through never reached Mongo (all cache hits), so it proves nothing either way"""
+        if self.state == "half_open":
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        now = time.monotonic()
+        self.trial_in_flight = False
+        self.failures.append(now)
+        while self.failures and now - self.failures[0] > BREAKER_WINDOW_SECONDS:
+            self.failures.popleft()
+        if self.state == "half_open" or (self.state == "closed" and len(self.failures) >= BREAKER_FAILURE_THRESHOLD):
+            if self.state == "closed":
+                logger.warning(f"MongoDB circuit breaker opened after {len(self.failures)} failures")
+            self.state = "open"
+            self.opened_at = now
+            self.times_opened += 1
+
+    def retry_after(self) -> int:
+        if self.state == "closed":
+            return 1
+        return max(1, math.ceil(BREAKER_RESET_SECONDS - (time.monotonic() - self.opened_at)))
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        return {
+            "state": self.state,
+            "recent_failures": sum(1 for t in self.failures if now - t <= BREAKER_WINDOW_SECONDS),
+            "times_opened": self.times_opened,
+            "rejected_requests": self.rejected,
+            "retry_after_seconds": self.retry_after() if self.state != "closed" else 0,
+        }
+
+circuit_breaker = CircuitBreaker()
+
+async def guard_database(request: Request):
+    """Router dependency: fail fast while the breaker is open, otherwise give the request a Mongo deadline.
+
+    Only requests that sent a command count as a success, so a half-open breaker isn't closed by
+    a request answered entirely from cache.
+    """
+    if not circuit_breaker.allow():
+        raise DatabaseUnavailable()
+    deadline = MONGO_READ_TIMEOUT_SECONDS if request.method in ("GET", "HEAD") else MONGO_WRITE_TIMEOUT_SECONDS
+    # Each request runs in its own context, so this doesn't leak into other requests
+    usage = {"reached": False}
+    request_mongo_usage.set(usage)
+    failed = False
+    try:
+        with pymongo.timeout(deadline):
+            yield
+    except MONGO_UNAVAILABLE_ERRORS:
+        failed = True
+        circuit_breaker.record_failure()
+        raise
+    finally:
+        if not failed:
+            if usage["reached"]:
+                circuit_breaker.record_success()
+            else:
+                circuit_breaker.release()
+
+# Public read routes that may answer with their last good response while Mongo is unavailable,
+# mapped to a function from the path parameters to that response (None when there is none)
+stale_fallbacks = {}
+
+def serves_stale(fallback):
+    def register(endpoint):
+        stale_fallbacks[endpoint] = fallback
+        return endpoint
+    return register
+
+async def database_unavailable_handler(request: Request, exc: Exception):
+    route = request.scope.get("route")
+    fallback = stale_fallbacks.get(getattr(route, "endpoint", None))
+    if fallback and request.method == "GET":
+        response = fallback(request.path_params)
+        if isinstance(response, Snapshot):
+            return response.response(request, headers={"Warning": '110 - "Response is Stale"'})
+        if response is not None:
+            return JSONResponse(jsonable_encoder(response), headers={"Warning": '110 - "Response is Stale"'})
+    return JSONResponse(
+        {"detail": "Database temporarily unavailable, please try again shortly"},
+        status_code=503,
+        headers={"Retry-After": str(circuit_breaker.retry_after())},
+    )
+
+
+# ============ RATE LIMITING ============
+
+# Token-bucket limits for the unauthenticated public routes, as "<requests>/<period>".
+# Each rule can be overridden with an env var, e.g. RATE_LIMIT_REDEEM_COUPON_IP=10/minute
+RATE_LIMIT_RULES = {
+    "generate-coupon": {"ip": "10/minute"},
+    "track-share": {"ip": "30/minute", "coupon": "10/minute"},
+    "redeem-coupon": {"ip": "30/minute", "coupon": "5/minute"},
+    "batch": {"ip": "60/minute"},
+}
+RATE_LIMIT_PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+def parse_rate_limit(value: str):
+    """Parse "10/minute" into (capacity, tokens refilled per second)"""
+    count, _, period = value.partition('/')
+    seconds = RATE_LIMIT_PERIODS.get(period.strip(), None)
+    if seconds is None:
+        seconds = float(period)
+    capacity = int(count)
+    return capacity, capacity / seconds
+
+class MemoryRateLimitBackend:
+    """Per-process token buckets, bounded so a flood of distinct IPs can't exhaust memory"""
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self.buckets = {}
+
+    async def acquire(self, key: str, capacity: int, refill_rate: float):
+        now = time.monotonic()
+        tokens, last = self.buckets.pop(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - last) * refill_rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        if len(self.buckets) >= self.max_keys:
+            # dicts keep insertion order, and touched keys are re-inserted, so this drops the stalest bucket
+            self.buckets.pop(next(iter(self.buckets)))
+        self.buckets[key] = (tokens, now)
+        retry_after = 0 if allowed else (1 - tokens) / refill_rate
+        return allowed, retry_after
+
+class MongoRateLimitBackend:
+    """Token buckets shared by every worker, updated atomically with a pipeline upsert"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    async def acquire(self, key: str, capacity: int, refill_rate: float):
+        now = time.time()
+        refilled = {"$min": [capacity, {"$add": [
+            {"$ifNull": ["$tokens", capacity]},
+            {"$multiply": [{"$subtract": [now, {"$ifNull": ["$ts", now]}]}, refill_rate]},
+        ]}]}
+        bucket = await self.collection.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"tokens": refilled, "ts": now}},
+                {"$set": {"allowed": {"$gte": ["$tokens", 1]}}},
+                {"$set": {
+                    "tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", 1]}, "$tokens"]},
+                    "expires_at": datetime.now(timezone.utc) + timedelta(seconds=capacity / refill_rate),
+                }},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        allowed = bucket["allowed"]
+        retry_after = 0 if allowed else (1 - bucket["tokens"]) / refill_rate
+        return allowed, retry_after
+
+if os.environ.get('RATE_LIMIT_BACKEND', 'memory') == 'mongo':
+    rate_limit_backend = MongoRateLimitBackend(db.rate_limits)
+else:
+    rate_limit_backend = MemoryRateLimitBackend()
+
+# Proxies allowed to report the client address in X-Forwarded-For, as IPs or CIDR ranges.
+# "*" trusts the direct peer whatever its address, for hosts like Render where the app is only
+# reachable through a load balancer whose addresses aren't published
+TRUSTED_PROXIES = [p.strip() for p in os.environ.get('TRUSTED_PROXIES', '').split(',') if p.strip()]
+TRUSTED_PROXY_NETWORKS = [ipaddress.ip_network(p, strict=False) for p in TRUSTED_PROXIES if p != '*']
+
+def is_trusted_proxy(host: str) -> bool:
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in TRUSTED_PROXY_NETWORKS)
+
+def get_client_ip(request: Request) -> str:
+    """The visitor's address, read from X-Forwarded-For only when the peer is a trusted proxy.
+
+    Each proxy appends the address it saw, so hops are taken from the right until one isn't
+    a trusted proxy; anything further left was supplied by the client and may be spoofed.
+    """
+    client_ip = request.client.host if request.client else "unknown"
+    if '*' not in TRUSTED_PROXIES and not is_trusted_proxy(client_ip):
+        return client_ip
+    forwarded = [hop.strip() for hop in request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+    for hop in reversed(forwarded):
+        client_ip = hop
+        if not is_trusted_proxy(hop):
+            break
+    return client_ip
+
+def get_rate_limit_rules(route: str) -> dict:
+    rules = {}
+    for key_type, default in RATE_LIMIT_RULES[route].items():
+        env_name = f"RATE_LIMIT_{route}_{key_type}".upper().replace('-', '_')
+        rules[key_type] = parse_rate_limit(os.environ.get(env_name, default))
+    return rules
+
+async def enforce_rate_limit(route: str, rules: dict, keys: dict):
+    """Take a token from every bucket that applies, raising 429 as soon as one is empty"""
+    for key_type, (capacity, refill_rate) in rules.items():
+        if key_type not in keys:
+            continue
+        allowed, retry_after = await rate_limit_backend.acquire(
+            f"{route}:{key_type}:{keys[key_type]}", capacity, refill_rate
+        )
+        if not allowed:
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests, please try again later",
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+            )
+
+def rate_limit(route: str):
+    """Dependency that rejects excess requests with 429 before the route touches the database"""
+    rules = get_rate_limit_rules(route)
+
+    async def check(request: Request):
+        keys = {"ip": get_client_ip(request)}
+        if "coupon" in rules:
+            try:
+                body = await request.json()
+            except ValueError:
+                body = None
+            if isinstance(body, dict) and body.get('coupon_code'):
+                keys["coupon"] = str(body['coupon_code'])
+
+        await enforce_rate_limit(route, rules, keys)
+
+    return check
+
+
+# ============ COUPON RETENTION ============
+
+# Anonymous coupons that are never shared or redeemed expire after this many hours (0 disables)
+ANONYMOUS_COUPON_TTL_HOURS = float(os.environ.get('ANONYMOUS_COUPON_TTL_HOURS', '72'))
+# Redeemed coupons move to coupons_archive this many days after redemption
+REDEEMED_ARCHIVE_AFTER_DAYS = float(os.environ.get('REDEEMED_ARCHIVE_AFTER_DAYS', '30'))
+COUPON_SWEEP_INTERVAL_SECONDS = float(os.environ.get('COUPON_SWEEP_INTERVAL_SECONDS', '3600'))
+COUPON_SWEEP_BATCH_SIZE = int(os.environ.get('COUPON_SWEEP_BATCH_SIZE', '500'))
+
+def anonymous_coupon_expiry() -> Optional[datetime]:
+    """BSON date picked up by the TTL index on coupons.expires_at"""
+    if ANONYMOUS_COUPON_TTL_HOURS <= 0:
+        return None
+    return datetime.now(timezone.utc) + timedelta(hours=ANONYMOUS_COUPON_TTL_HOURS)
+
+async def find_coupon(query: dict, projection: Optional[dict] = None, public: bool = False,
+                      trust_filter: bool = True):
+    """Look a coupon up in the hot collection, falling back to the archive of old redemptions.
+
+    Concurrent identical lookups are coalesced, so the returned document must not be mutated.
+    public=True reads through public_db, for pages that can show slightly stale data.
+    trust_filter=False asks Mongo on a coupon code filter miss, for routes that write.
+    """
+    coupon_code = query.get("coupon_code")
+    if isinstance(coupon_code, str) and coupon_code_missing(coupon_code, trust_filter):
+        return None
+    sources = (public_db, db) if public and public_db is not db else (db,)
+
+    async def lookup():
+        generation = missing_coupon_cache.generation
+        for source in sources:
+            coupon = await source.coupons.find_one(query, projection)
+            if coupon is None:
+                coupon = await source.coupons_archive.find_one(query, projection)
+            if coupon is not None:
+                return coupon
+            # A coupon missing from a secondary may just not have replicated yet
+        if list(query) == ["coupon_code"]:
+            missing_coupon_cache.set(coupon_code, True, generation)
+
+    return await read_flight.do((flight_key("coupons", query, projection), len(sources)), lookup)
+
+async def ensure_coupon_indexes():
+    await db.coupons.create_index("expires_at", expireAfterSeconds=0)
+    # For the sweeper: redeemed coupons due for the archive, and legacy unredeemed ones by age
+    await db.coupons.create_index([("is_redeemed", 1), ("redeemed_at", 1)])
+    await db.coupons.create_index([("is_redeemed", 1), ("created_at", 1)])
+    await db.coupons_archive.create_index("coupon_code")
+    await db.coupons_archive.create_index("shopkeeper_id")
+    await db.coupons_archive.create_index("customer_id")
+
+async def sweep_legacy_anonymous_coupons() -> int:
+    """Delete abandoned anonymous coupons created before expires_at was stamped on them"""
+    if ANONYMOUS_COUPON_TTL_HOURS <= 0:
+        return 0
+    cutoff = (datetime.now(timezone.utc) - timedelta(hours=ANONYMOUS_COUPON_TTL_HOURS)).isoformat()
+    query = {
+        "customer_id": {"$regex": "^anonymous_"},
+        "expires_at": {"$exists": False},
+        "share_clicked": {"$ne": True},
+        "is_redeemed": False,
+        "created_at": {"$lt": cutoff},
+    }
+    deleted = 0
+    while True:
+        batch = await db.coupons.find(query, {"_id": 1}).limit(COUPON_SWEEP_BATCH_SIZE).to_list(COUPON_SWEEP_BATCH_SIZE)
+        if not batch:
+            return deleted
+        result = await db.coupons.delete_many({"_id": {"$in": [c["_id"] for c in batch]}})
+        deleted += result.deleted_count
+        await asyncio.sleep(0)
+
+async def archive_redeemed_coupons() -> int:
+    """Move coupons redeemed more than REDEEMED_ARCHIVE_AFTER_DAYS ago into coupons_archive"""
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=REDEEMED_ARCHIVE_AFTER_DAYS)).isoformat()
+    query = {"is_redeemed": True, "redeemed_at": {"$lt": cutoff}}
+    archived = 0
+    while True:
+        batch = await db.coupons.find(query).limit(COUPON_SWEEP_BATCH_SIZE).to_list(COUPON_SWEEP_BATCH_SIZE)
+        if not batch:
+            return archived
+        # Upserts keep this safe to rerun if a previous sweep died between the copy and the delete
+        await db.coupons_archive.bulk_write(
+            [ReplaceOne({"_id": c["_id"]}, c, upsert=True) for c in batch], ordered=False
+        )
+        result = await db.coupons.delete_many({"_id": {"$in": [c["_id"] for c in batch]}})
+        archived += result.deleted_count
+        await asyncio.sleep(0)
+
+async def claim_coupon_sweep() -> bool:
+    """Lease the next sweep for this worker, so it runs once per interval rather than once per worker"""
+    now = datetime.now(timezone.utc)
+    try:
+        lock = await db.locks.find_one_and_update(
+            {"_id": "coupon_sweeper", "locked_until": {"$lte": now}},
+            {"$set": {"locked_until": now + timedelta(seconds=COUPON_SWEEP_INTERVAL_SECONDS)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        # Another worker holds the lease, so the upsert's insert collided with its document
+        return False
+    return lock is not None
+
+async def coupon_sweeper():
+    while True:
+        try:
+            if await claim_coupon_sweep():
+                deleted = await sweep_legacy_anonymous_coupons()
+                archived = await archive_redeemed_coupons()
+                if deleted or archived:
+                    logger.info(f"Coupon sweep: deleted {deleted} abandoned, archived {archived} redeemed")
+        except Exception:
+            logger.exception("Coupon sweep failed")
+        await asyncio.sleep(COUPON_SWEEP_INTERVAL_SECONDS)
+
+
+# ============ COUPON CODE FILTER ============
+
+# Scrapers enumerate made-up coupon codes. A Bloom filter of every existing code answers
+# "definitely not a coupon" from memory; it can't produce false negatives, only the odd false
+# positive that falls through to Mongo as before. Codes this worker looked up and didn't find
+# are also remembered for a short while, which covers the time the filter can't be trusted.
+# Routes that write skip the filter, so a coupon just created on another worker is still found.
+COUPON_FILTER_FALSE_POSITIVE_RATE = float(os.environ.get('COUPON_FILTER_FALSE_POSITIVE_RATE', '0.01'))
+COUPON_FILTER_REBUILD_SECONDS = float(os.environ.get('COUPON_FILTER_REBUILD_SECONDS', '21600'))
+NEGATIVE_CACHE_TTL_SECONDS = float(os.environ.get('NEGATIVE_CACHE_TTL_SECONDS', '30'))
+# Room left for codes created between rebuilds, as a multiple of the current coupon count
+COUPON_FILTER_HEADROOM = 2
+COUPON_FILTER_MIN_CAPACITY = 100000
+
+class BloomFilter:
+    def __init__(self, capacity: int, false_positive_rate: float):
+        self.size = max(8, int(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        # Double hashing: k positions from the two halves of one 128-bit digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+class CouponCodeFilter:
+    """Bloom filter of every coupon code, kept current by local inserts and the change stream.
+
+    Codes inserted by other workers only arrive through the change stream, so the filter is only
+    trusted while the stream has been live since the filter was built and is caught up with recent
+    writes; otherwise a miss goes to MongoDB like any other lookup.
+    """
+
+    def __init__(self):
+        self.filter = None
+        self.building = None
+        self.epoch = None
+        self.built_at = 0.0
+        self.rejected = 0
+
+    def add(self, coupon_code: str):
+        for bloom in (self.filter, self.building):
+            if bloom is not None:
+                bloom.add(coupon_code)
+
+    def definitely_missing(self, coupon_code: str) -> bool:
+        if self.filter is None or not cache_invalidator.caught_up() or self.epoch != cache_invalidator.epoch:
+            return False
+        if coupon_code in self.filter:
+            return False
+        self.rejected += 1
+        return True
+
+    async def rebuild(self):
+        epoch = cache_invalidator.epoch
+        existing = await db.coupons.estimated_document_count() + await db.coupons_archive.estimated_document_count()
+        # Codes inserted while this runs go into both filters through add()
+        self.building = BloomFilter(
+            max(COUPON_FILTER_MIN_CAPACITY, existing * COUPON_FILTER_HEADROOM), COUPON_FILTER_FALSE_POSITIVE_RATE
+        )
+        try:
+            for collection in (db.coupons, db.coupons_archive):
+                async for coupon in collection.find({}, {"_id": 0, "coupon_code": 1}).batch_size(5000):
+                    if coupon.get('coupon_code'):
+                        self.building.add(coupon['coupon_code'])
+            self.filter, self.epoch = self.building, epoch
+            self.built_at = time.monotonic()
+        finally:
+            self.building = None
+        logger.info(f"Coupon code filter built with {self.filter.count} codes")
+
+    async def maintainer(self):
+        """Rebuild once the change stream is live, after every reconnect and every COUPON_FILTER_REBUILD_SECONDS"""
+        while True:
+            try:
+                if cache_invalidator.live and (
+                    self.epoch != cache_invalidator.epoch
+                    or time.monotonic() - self.built_at > COUPON_FILTER_REBUILD_SECONDS
+                ):
+                    await self.rebuild()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Coupon code filter rebuild failed")
+            await asyncio.sleep(5)
+
+    def snapshot(self) -> dict:
+        return {
+            "trusted": self.filter is not None and cache_invalidator.caught_up() and self.epoch == cache_invalidator.epoch,
+            "codes": self.filter.count if self.filter else 0,
+            "size_bytes": len(self.filter.bits) if self.filter else 0,
+            "rejected_lookups": self.rejected,
+        }
+
+coupon_code_filter = CouponCodeFilter()
+missing_coupon_cache = TTLCache("missing_coupons", max_entries=50000, ttl_seconds=NEGATIVE_CACHE_TTL_SECONDS)
+
+def remember_coupon_code(coupon_code: str):
+    coupon_code_filter.add(coupon_code)
+    missing_coupon_cache.invalidate(coupon_code)
+
+def coupon_code_missing(coupon_code: str, trust_filter: bool = True) -> bool:
+    """True when the code is known not to exist, without asking Mongo.
+
+    trust_filter=False only consults the negative cache: a code another worker just inserted
+    isn't in this worker's filter until its change event arrives, which writes can't wait for.
+    """
+    if missing_coupon_cache.get(coupon_code) is not CACHE_MISS:
+        return True
+    return trust_filter and coupon_code_filter.definitely_missing(coupon_code)
+
+def on_coupon_change(coupon: dict):
+    if coupon.get('coupon_code'):
+        remember_coupon_code(coupon['coupon_code'])
+
+cache_invalidator.watch("coupons", on_coupon_change)
+
+
+# ============ DELETION JOBS ============
+
+# Shopkeeper deletions are queued in deletion_jobs and their coupons removed in throttled batches
+DELETION_BATCH_SIZE = int(os.environ.get('DELETION_BATCH_SIZE', '500'))
+DELETION_BATCH_PAUSE_SECONDS = float(os.environ.get('DELETION_BATCH_PAUSE_SECONDS', '0.2'))
+DELETION_POLL_INTERVAL_SECONDS = float(os.environ.get('DELETION_POLL_INTERVAL_SECONDS', '10'))
+# A worker that dies mid-job loses its claim after this long, so another worker (or the restarted one) resumes it
+DELETION_LEASE_SECONDS = 300
+
+deletion_wakeup = asyncio.Event()
+
+async def enqueue_shopkeeper_deletion(shopkeeper_id: str) -> str:
+    now = datetime.now(timezone.utc)
+    job_id = str(uuid.uuid4())
+    await db.deletion_jobs.insert_one({
+        "id": job_id,
+        "shopkeeper_id": shopkeeper_id,
+        "status": "pending",
+        "coupons_deleted": 0,
+        "created_at": now.isoformat(),
+        "updated_at": now.isoformat(),
+        "locked_until": now,
+    })
+    deletion_wakeup.set()
+    return job_id
+
+async def claim_deletion_job():
+    now = datetime.now(timezone.utc)
+    return await db.deletion_jobs.find_one_and_update(
+        {"status": {"$in": ["pending", "running"]}, "locked_until": {"$lte": now}},
+        {"$set": {
+            "status": "running",
+            "locked_until": now + timedelta(seconds=DELETION_LEASE_SECONDS),
+            "updated_at": now.isoformat(),
+        }},
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+async def run_deletion_job(job: dict):
+    shopkeeper_id = job["shopkeeper_id"]
+    for collection in (db.coupons, db.coupons_archive):
+        while True:
+            batch = await collection.find({"shopkeeper_id": shopkeeper_id}, {"_id": 1}) \
+                .limit(DELETION_BATCH_SIZE).to_list(DELETION_BATCH_SIZE)
+            if not batch:
+                break
+            result = await collection.delete_many({"_id": {"$in": [c["_id"] for c in batch]}})
+            now = datetime.now(timezone.utc)
+            await db.deletion_jobs.update_one(
+                {"id": job["id"]},
+                {"$inc": {"coupons_deleted": result.deleted_count},
+                 "$set": {"updated_at": now.isoformat(),
+                          "locked_until": now + timedelta(seconds=DELETION_LEASE_SECONDS)}}
+            )
+            await asyncio.sleep(DELETION_BATCH_PAUSE_SECONDS)
+
+    # Normally already gone, unless the request that queued the job failed before removing them
+    await db.shopkeeper_profiles.delete_one({"shopkeeper_id": shopkeeper_id})
+    await db.share_cards.delete_one({"shopkeeper_id": shopkeeper_id})
+    cache_invalidator.publish("shopkeeper_profiles", {"shopkeeper_id": shopkeeper_id})
+    cache_invalidator.publish("share_cards", {"shopkeeper_id": shopkeeper_id})
+
+    # Tokens carry the role, so a tombstone keeps them rejected once the user document is gone
+    await db.revoked_users.update_one(
+        {"id": shopkeeper_id},
+        {"$set": {"id": shopkeeper_id, "expires_at": datetime.now(timezone.utc) + ACCESS_TOKEN_LIFETIME}},
+        upsert=True
+    )
+    await db.users.delete_one({"id": shopkeeper_id})
+    await db.deletion_jobs.update_one(
+        {"id": job["id"]},
+        {"$set": {"status": "done", "updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+
+async def deletion_worker():
+    while True:
+        deletion_wakeup.clear()
+        try:
+            job = await claim_deletion_job()
+            if job:
+                await run_deletion_job(job)
+                continue
+        except Exception:
+            logger.exception("Shopkeeper deletion job failed")
+        try:
+            await asyncio.wait_for(deletion_wakeup.wait(), DELETION_POLL_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+
+# ============ IDEMPOTENCY ============
+
+IDEMPOTENCY_TTL_HOURS = float(os.environ.get('IDEMPOTENCY_TTL_HOURS', '24'))
+# How long a retry waits for another worker that is still processing the same key. The wait
+# also ends this long before the request's Mongo deadline, so it answers 409 instead of timing out
+IDEMPOTENCY_WAIT_SECONDS = 5
+IDEMPOTENCY_DEADLINE_MARGIN_SECONDS = 0.5
+# A pending key is leased for this long; a worker that times out or dies mid-request leaves it
+# pending, and retries take it over once the lease runs out instead of getting 409 until expiry.
+# Shorter than the write deadline, so a retry can still take over within its own request
+IDEMPOTENCY_LEASE_SECONDS = float(os.environ.get('IDEMPOTENCY_LEASE_SECONDS', '2'))
+
+idempotency_flight = SingleFlight()
+
+async def ensure_idempotency_indexes():
+    await db.idempotency_keys.create_index("expires_at", expireAfterSeconds=0)
+
+async def run_idempotent(scope: str, idempotency_key: Optional[str], fingerprint: str, create):
+    """Run create() once per Idempotency-Key and replay its JSON response for retries"""
+    if not idempotency_key:
+        return await create()
+    store_key = f"{scope}:{idempotency_key}"
+    return await idempotency_flight.do(
+        (store_key, fingerprint), lambda: _run_idempotent(store_key, fingerprint, create)
+    )
+
+async def _run_idempotent(store_key: str, fingerprint: str, create):
+    lease = uuid.uuid4().hex
+    now = datetime.now(timezone.utc)
+    try:
+        await db.idempotency_keys.insert_one({
+            "_id": store_key,
+            "fingerprint": fingerprint,
+            "status": "pending",
+            "lease": lease,
+            "locked_until": now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS),
+            "expires_at": now + timedelta(hours=IDEMPOTENCY_TTL_HOURS),
+        })
+    except DuplicateKeyError:
+        done = await _wait_for_idempotent_response(store_key, fingerprint, lease)
+        if done is not None:
+            return done["response"]
+
+    try:
+        response = await create()
+    except Exception:
+        # Release the key so the client can retry after a failure, unless another request took it over
+        await db.idempotency_keys.delete_one({"_id": store_key, "lease": lease})
+        raise
+
+    await db.idempotency_keys.update_one(
+        {"_id": store_key, "lease": lease},
+        {"$set": {"status": "done", "response": response}, "$unset": {"locked_until": ""}}
+    )
+    return response
+
+async def _wait_for_idempotent_response(store_key: str, fingerprint: str, lease: str):
+    """The finished key document, or None once this request has taken over an expired lease"""
+    wait = IDEMPOTENCY_WAIT_SECONDS
+    remaining = _csot.remaining()
+    if remaining is not None:
+        wait = min(wait, remaining - IDEMPOTENCY_DEADLINE_MARGIN_SECONDS)
+    deadline = time.monotonic() + wait
+    while True:
+        if time.monotonic() >= deadline:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+        existing = await db.idempotency_keys.find_one({"_id": store_key})
+        if existing is None:
+            raise HTTPException(status_code=409, detail="Previous request with this Idempotency-Key failed, please retry")
+        if existing["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+        if existing["status"] == "done":
+            return existing
+        locked_until = existing.get("locked_until")
+        if locked_until is None or locked_until.replace(tzinfo=timezone.utc) <= datetime.now(timezone.utc):
+            # Swap on the old lease so only one waiter wins the takeover
+            now = datetime.now(timezone.utc)
+            taken = await db.idempotency_keys.find_one_and_update(
+                {"_id": store_key, "status": "pending", "lease": existing.get("lease")},
+                {"$set": {"lease": lease, "locked_until": now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)}},
+            )
+            if taken is not None:
+                return None
+            continue
+        await asyncio.sleep(max(0, min(0.1, deadline - time.monotonic())))
+
+
+# ============ EXPORT ============
+
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '2000'))
+EXPORT_COLUMNS = [
+    "coupon_code", "customer_id", "customer_username", "click_count", "share_clicked",
+    "is_redeemed", "cashback_earned", "created_at", "redeemed_at",
+]
+EXPORT_FORMATS = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+async def lookup_usernames(customer_ids) -> dict:
+    """One $in query for a batch of customers instead of a find_one per coupon"""
+    ids = list({cid for cid in customer_ids if not cid.startswith("anonymous_")})
+    if not ids:
+        return {}
+    users = await db.users.find({"id": {"$in": ids}}, {"_id": 0, "id": 1, "username": 1}).to_list(len(ids))
+    return {u['id']: u['username'] for u in users}
+
+async def iter_coupon_export_frames(shopkeeper_id: str, batch_size: int = EXPORT_BATCH_SIZE):
+    """Yield a store's coupons, live then archived, as DataFrames of at most batch_size rows"""
+    projection = {"_id": 0, **{column: 1 for column in EXPORT_COLUMNS if column != "customer_username"}}
+    for collection in (db.coupons, db.coupons_archive):
+        cursor = collection.find({"shopkeeper_id": shopkeeper_id}, projection).batch_size(batch_size)
+        chunk = []
+        async for doc in cursor:
+            chunk.append(doc)
+            if len(chunk) >= batch_size:
+                yield await build_export_frame(chunk)
+                chunk = []
+        if chunk:
+            yield await build_export_frame(chunk)
+
+async def build_export_frame(docs: list):
+    usernames = await lookup_usernames(doc['customer_id'] for doc in docs)
+    frame = pd.DataFrame(docs, columns=EXPORT_COLUMNS)
+    frame["customer_username"] = frame["customer_id"].map(usernames).fillna("Unknown")
+    frame["click_count"] = frame["click_count"].fillna(0).astype("int64")
+    frame["share_clicked"] = frame["share_clicked"].fillna(False).astype(bool)
+    frame["cashback_earned"] = frame["cashback_earned"].fillna("")
+    return frame
+
+class _ParquetChunkSink(io.RawIOBase):
+    """Write-only file that hands back whatever pyarrow has written so far"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+async def stream_coupon_export(shopkeeper_id: str, export_format: str):
+    """Encode the export chunk by chunk so memory stays flat regardless of store size"""
+    if export_format == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        # Fixed schema so a chunk where every redeemed_at is null still matches the others
+        schema = pa.schema([
+            (column, pa.int64() if column == "click_count"
+             else pa.bool_() if column in ("share_clicked", "is_redeemed")
+             else pa.string())
+            for column in EXPORT_COLUMNS
+        ])
+        sink = _ParquetChunkSink()
+        writer = pq.ParquetWriter(sink, schema)
+        async for frame in iter_coupon_export_frames(shopkeeper_id):
+            writer.write_table(pa.Table.from_pandas(frame, schema=schema, preserve_index=False))
+            yield sink.drain()
+        writer.close()
+        yield sink.drain()
+    else:
+        header = True
+        async for frame in iter_coupon_export_frames(shopkeeper_id):
+            yield frame.to_csv(index=False, header=header).encode('utf-8')
+            header = False
+        if header:
+            yield (",".join(EXPORT_COLUMNS) + "\n").encode('utf-8')
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+# ============ FRAUD SCORING ============
+
+# Redemptions are scored off the request path: the redeem route only drops an event on
+# the queue, and workers score events in batches and flag suspicious coupons.
+FRAUD_QUEUE_SIZE = int(os.environ.get('FRAUD_QUEUE_SIZE', '10000'))
+FRAUD_WORKERS = int(os.environ.get('FRAUD_WORKERS', '1'))
+FRAUD_BATCH_SIZE = int(os.environ.get('FRAUD_BATCH_SIZE', '200'))
+FRAUD_BATCH_WAIT_SECONDS = float(os.environ.get('FRAUD_BATCH_WAIT_SECONDS', '1'))
+FRAUD_FLAG_THRESHOLD = float(os.environ.get('FRAUD_FLAG_THRESHOLD', '1.0'))
+# Each feature contributes its weight once it crosses its limit
+FRAUD_IP_WINDOW_SECONDS = 600
+FRAUD_IP_LIMIT = int(os.environ.get('FRAUD_IP_LIMIT', '5'))  # redemptions per IP per 10 minutes
+FRAUD_STORE_WINDOW_SECONDS = 60
+FRAUD_STORE_LIMIT = int(os.environ.get('FRAUD_STORE_LIMIT', '30'))  # redemptions per store per minute
+FRAUD_MIN_SHARE_SECONDS = float(os.environ.get('FRAUD_MIN_SHARE_SECONDS', '3'))  # faster than a human can share
+
+class SlidingWindowCounter:
+    """Event timestamps per key over a fixed window, with empty keys dropped as they age out"""
+
+    def __init__(self, window_seconds: float):
+        self.window_seconds = window_seconds
+        self.events = {}
+
+    def add(self, key: str, timestamp: float) -> int:
+        events = self.events.setdefault(key, deque())
+        events.append(timestamp)
+        while events and events[0] <= timestamp - self.window_seconds:
+            events.popleft()
+        return len(events)
+
+    def prune(self, now: float):
+        for key in [k for k, events in self.events.items() if not events or events[-1] <= now - self.window_seconds]:
+            del self.events[key]
+
+class FraudScorer:
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=FRAUD_QUEUE_SIZE)
+        self.ip_counter = SlidingWindowCounter(FRAUD_IP_WINDOW_SECONDS)
+        self.store_counter = SlidingWindowCounter(FRAUD_STORE_WINDOW_SECONDS)
+        self.dropped = 0
+        self.flagged = 0
+
+    def submit(self, event: dict):
+        """Never blocks the caller; when the queue is full the event is dropped and counted"""
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def score(self, event: dict):
+        reasons = {}
+        ip_count = self.ip_counter.add(event["ip"], event["timestamp"])
+        if ip_count > FRAUD_IP_LIMIT:
+            reasons["ip_rate"] = ip_count
+        store_count = self.store_counter.add(event["shopkeeper_id"], event["timestamp"])
+        if store_count > FRAUD_STORE_LIMIT:
+            reasons["store_rate"] = store_count
+        latency = event.get("share_to_redeem_seconds")
+        if latency is not None and latency < FRAUD_MIN_SHARE_SECONDS:
+            reasons["share_to_redeem_seconds"] = round(latency, 3)
+        return float(len(reasons)), reasons
+
+    async def next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + FRAUD_BATCH_WAIT_SECONDS
+        while len(batch) < FRAUD_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def process(self, batch: list):
+        flags = []
+        for event in batch:
+            score, reasons = self.score(event)
+            if score >= FRAUD_FLAG_THRESHOLD:
+                flags.append({**event, "score": score, "reasons": reasons,
+                              "flagged_at": datetime.now(timezone.utc).isoformat()})
+        now = batch[-1]["timestamp"]
+        self.ip_counter.prune(now)
+        self.store_counter.prune(now)
+        if not flags:
+            return
+        await db.redemption_flags.insert_many([dict(flag) for flag in flags])
+        await db.coupons.bulk_write([
+            UpdateOne({"coupon_code": flag["coupon_code"]}, {"$set": {"fraud_flagged": True, "fraud_reasons": flag["reasons"]}})
+            for flag in flags
+        ], ordered=False)
+        self.flagged += len(flags)
+
+    async def worker(self):
+        while True:
+            batch = await self.next_batch()
+            try:
+                await self.process(batch)
+            except Exception:
+                logger.exception("Fraud scoring batch failed")
+
+fraud_scorer = FraudScorer()
+
+
+# ============ BACKGROUND JOBS ============
+
+# Side effects a route hands off so it can respond as soon as its critical write is done.
+# Every job is written to job_outbox before it runs, so a crash or restart only delays it:
+# the poller picks up any job whose lease has run out, including retries waiting out their backoff.
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '4'))
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', '1000'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '5'))
+JOB_RETRY_BASE_SECONDS = float(os.environ.get('JOB_RETRY_BASE_SECONDS', '2'))
+JOB_POLL_INTERVAL_SECONDS = float(os.environ.get('JOB_POLL_INTERVAL_SECONDS', '5'))
+JOB_TIMEOUT_SECONDS = 60
+# A claimed job that isn't finished within this long is assumed lost and runs again
+JOB_LEASE_SECONDS = 120
+
+job_handlers = {}
+
+def job_handler(name: str):
+    """Register an async handler(payload) for jobs of this name.
+
+    A job can run more than once (a worker may die after the work but before recording it),
+    so handlers must be idempotent.
+    """
+    def register(handler):
+        job_handlers[name] = handler
+        return handler
+    return register
+
+class JobQueue:
+    """In-process queue drained by JOB_WORKERS tasks, backed by the job_outbox collection"""
+
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=JOB_QUEUE_SIZE)
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+
+    async def ensure_indexes(self):
+        await db.job_outbox.create_index("id", unique=True)
+        await db.job_outbox.create_index([("status", 1), ("locked_until", 1)])
+
+    async def enqueue(self, name: str, payload: dict) -> str:
+        now = datetime.now(timezone.utc)
+        job = {
+            "id": str(uuid.uuid4()),
+            "name": name,
+            "payload": payload,
+            "status": "pending",
+            "attempts": 0,
+            "created_at": now.isoformat(),
+            # Leased to this process straight away, the poller only sees it if we never finish
+            "locked_until": now + timedelta(seconds=JOB_LEASE_SECONDS),
+        }
+        await db.job_outbox.insert_one(job)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            logger.warning(f"Job queue full, {name} job {job['id']} waits for the poller")
+        return job["id"]
+
+    async def claim(self):
+        now = datetime.now(timezone.utc)
+        return await db.job_outbox.find_one_and_update(
+            {"status": "pending", "locked_until": {"$lte": now}},
+            {"$set": {"locked_until": now + timedelta(seconds=JOB_LEASE_SECONDS)}},
+            sort=[("locked_until", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def run(self, job: dict):
+        attempts = job["attempts"] + 1
+        try:
+            handler = job_handlers.get(job["name"])
+            if handler is None:
+                raise LookupError(f"No handler registered for {job['name']} jobs")
+            await asyncio.wait_for(handler(job["payload"]), JOB_TIMEOUT_SECONDS)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            now = datetime.now(timezone.utc)
+            update = {"attempts": attempts, "error": repr(e), "updated_at": now.isoformat()}
+            if attempts >= JOB_MAX_ATTEMPTS:
+                self.failed += 1
+                logger.exception(f"{job['name']} job {job['id']} failed after {attempts} attempts")
+                update["status"] = "failed"
+            else:
+                self.retried += 1
+                logger.warning(f"{job['name']} job {job['id']} failed (attempt {attempts}), retrying: {e}")
+                update["locked_until"] = now + timedelta(seconds=JOB_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+            await db.job_outbox.update_one({"id": job["id"]}, {"$set": update})
+            return
+        self.completed += 1
+        await db.job_outbox.delete_one({"id": job["id"]})
+
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self.run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # The outbox update itself failed, the lease brings the job back later
+                logger.exception(f"Could not record the outcome of {job['name']} job {job['id']}")
+
+    async def poller(self):
+        """Feed the workers jobs left over from restarts, full queues and retries"""
+        while True:
+            try:
+                while not self.queue.full():
+                    job = await self.claim()
+                    if job is None:
+                        break
+                    self.queue.put_nowait(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Job outbox poll failed")
+            await asyncio.sleep(JOB_POLL_INTERVAL_SECONDS)
+
+    def snapshot(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+job_queue = JobQueue()
+
+
+# ============ SHARE CARDS ============
+
+# Link previews (WhatsApp, Telegram, ...) only read Open Graph tags, so each store's tags and a
+# small preview JPEG are rendered once per profile change into share_cards. Serving a share
+# link is then a cache hit plus string formatting, whatever the coupon code.
+SHARE_IMAGE_SIZE = (600, 315)  # 1.91:1, the ratio WhatsApp and Facebook crop previews to
+SHARE_IMAGE_QUALITY = int(os.environ.get('SHARE_IMAGE_QUALITY', '70'))
+# Without Pillow the uploaded image is used as-is, if it's small enough for WhatsApp to show and
+# a raster type; an uploaded SVG could run script on the API origin
+SHARE_IMAGE_MAX_BYTES = 300 * 1024
+SHARE_IMAGE_TYPES = ("image/jpeg", "image/png", "image/webp")
+# Where share links send people. Without it (and no concrete origin in CORS_ORIGINS) /api/share/*
+# answers 404 and the frontend keeps linking to /#/coupon/ directly
+FRONTEND_URL = (os.environ.get('FRONTEND_URL') or next(
+    (origin for origin in os.environ.get('CORS_ORIGINS', '*').split(',') if origin != '*'), ''
+)).rstrip('/')
+
+share_card_cache = TTLCache("share_cards", max_entries=1000)
+cache_invalidator.subscribe("share_cards", share_card_cache, "shopkeeper_id")
+
+def compress_share_image(data_url: Optional[str]):
+    """Shrink a profile's data: URL image to a preview JPEG.
+    
+    Returns (bytes, content type, (width, height)), the size being None when it's unknown,
+    or (None, None, None) when there's nothing usable.
+    """
+    if not data_url or not data_url.startswith("data:") or "," not in data_url:
+        return None, None, None
+    header, encoded = data_url.split(",", 1)
+    content_type = header[len("data:"):].split(";")[0]
+    try:
+        raw = base64.b64decode(encoded)
+    except ValueError:
+        return None, None, None
+
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        if content_type in SHARE_IMAGE_TYPES and len(raw) <= SHARE_IMAGE_MAX_BYTES:
+            return raw, content_type, None
+        return None, None, None
+
+    try:
+        with Image.open(io.BytesIO(raw)) as source:
+            preview = ImageOps.fit(ImageOps.exif_transpose(source).convert("RGB"), SHARE_IMAGE_SIZE)
+        out = io.BytesIO()
+        preview.save(out, "JPEG", quality=SHARE_IMAGE_QUALITY, optimize=True, progressive=True)
+        return out.getvalue(), "image/jpeg", SHARE_IMAGE_SIZE
+    except Exception as e:
+        logger.warning(f"Could not render share image: {e}")
+        return None, None, None
+
+def render_share_meta(profile: dict) -> str:
+    """The store-specific part of the share page head, escaped once at render time"""
+    title = html.escape(f"{profile.get('store_name', 'Store')} - {profile.get('cashback_offer', 'No offer')}")
+    description = html.escape(profile.get('store_description') or "Share this coupon on WhatsApp and get cashback")
+    return (
+        f'<title>{title}</title>\n'
+        f'<meta property="og:type" content="website">\n'
+        f'<meta property="og:site_name" content="QuickCoupon">\n'
+        f'<meta property="og:title" content="{title}">\n'
+        f'<meta property="og:description" content="{description}">\n'
+        f'<meta name="description" content="{description}">'
+    )
+
+@job_handler("render_share_card")
+async def render_share_card(payload: dict):
+    shopkeeper_id = payload["shopkeeper_id"]
+    profile = await db.shopkeeper_profiles.find_one({"shopkeeper_id": shopkeeper_id}, {"_id": 0})
+    if profile is None:
+        await db.share_cards.delete_one({"shopkeeper_id": shopkeeper_id})
+    else:
+        # Image decoding is CPU-bound, keep it off the event loop
+        image, image_type, image_size = await asyncio.to_thread(compress_share_image, profile.get('promotional_image'))
+        meta_html = render_share_meta(profile)
+        digest = hashlib.sha1(meta_html.encode())
+        if image:
+            digest.update(image)
+        await db.share_cards.replace_one(
+            {"shopkeeper_id": shopkeeper_id},
+            {
+                "shopkeeper_id": shopkeeper_id,
+                "meta_html": meta_html,
+                "image": image,
+                "image_type": image_type,
+                "image_size": list(image_size) if image_size else None,
+                "version": digest.hexdigest()[:12],
+                "rendered_at": datetime.now(timezone.utc).isoformat(),
+            },
+            upsert=True
+        )
+    cache_invalidator.publish("share_cards", {"shopkeeper_id": shopkeeper_id})
+
+async def find_share_card(shopkeeper_id: str):
+    """A store's rendered share card, rendering it on first use for stores that predate share cards.
+
+    Unknown stores are cached as None without writing anything, so made-up ids cost one lookup.
+    """
+    async def lookup():
+        generation = share_card_cache.generation
+        card = await db.share_cards.find_one({"shopkeeper_id": shopkeeper_id}, {"_id": 0})
+        if card is None and await find_profile(shopkeeper_id) is not None:
+            await render_share_card({"shopkeeper_id": shopkeeper_id})
+            generation = share_card_cache.generation
+            card = await db.share_cards.find_one({"shopkeeper_id": shopkeeper_id}, {"_id": 0})
+        share_card_cache.set(shopkeeper_id, card, generation)
+        return card
+
+    card = share_card_cache.get(shopkeeper_id)
+    if card is not CACHE_MISS:
+        return card
+    return await read_flight.do(("share_cards", shopkeeper_id), lookup)
 
 
 # ============ AUTH ROUTES ============
 
+@job_handler("create_default_profile")
+async def create_default_profile(payload: dict):
+    """Give a new shopkeeper a starter profile, unless they already saved their own"""
+    now = datetime.now(timezone.utc).isoformat()
+    result = await db.shopkeeper_profiles.update_one(
+        {"shopkeeper_id": payload["shopkeeper_id"]},
+        {"$setOnInsert": {
+            "shopkeeper_id": payload["shopkeeper_id"],
+            "store_name": f"{payload['username']}'s Store",
+            "cashback_offer": "Special offer available",
+            "store_description": "Welcome to our store!",
+            "promotional_image": None,
+            "created_at": now,
+            "updated_at": now
+        }},
+        upsert=True
+    )
+    if result.upserted_id is not None:
+        cache_invalidator.publish("shopkeeper_profiles", {"shopkeeper_id": payload["shopkeeper_id"]})
+        await job_queue.enqueue("render_share_card", {"shopkeeper_id": payload["shopkeeper_id"]})
+
 @api_router.post("/auth/signup", response_model=TokenResponse)
 async def signup(user_create: UserCreate):
     # Check if user already exists
@@ -188,19 +2040,12 @@ async def signup(user_create: UserCreate):
     
     # Create default profile for shopkeepers
     if user_create.role == 'shopkeeper':
-        default_profile = {
-            "shopkeeper_id": user.id,
-            "store_name": f"{user_create.username}'s Store",
-            "cashback_offer": "Special offer available",
-            "store_description": "Welcome to our store!",
-            "promotional_image": None,
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "updated_at": datetime.now(timezone.utc).isoformat()
-        }
-        await db.shopkeeper_profiles.insert_one(default_profile)
+        await job_queue.enqueue("create_default_profile", {"shopkeeper_id": user.id, "username": user.username})
+    
+    cache_invalidator.publish("users", user_dict)
     
     # Create access token
-    access_token = create_access_token(data={"sub": user.id})
+    access_token = issue_access_token(user)
     
     return TokenResponse(access_token=access_token, user=user)
 
@@ -208,7 +2053,7 @@ async def signup(user_create: UserCreate):
 async def login(login_req: LoginRequest):
     # Find user
     user_doc = await db.users.find_one({"username": login_req.username}, {"_id": 0})
-    if not user_doc:
+    if not user_doc or user_doc.get('deleted_at'):
         raise HTTPException(status_code=401, detail="Invalid username or password")
     
     # Verify password
@@ -222,14 +2067,28 @@ async def login(login_req: LoginRequest):
     user = User(**user_doc)
     
     # Create access token
-    access_token = create_access_token(data={"sub": user.id})
+    access_token = issue_access_token(user, user_doc.get('token_version', 0))
     
     return TokenResponse(access_token=access_token, user=user)
 
 @api_router.get("/auth/me", response_model=User)
-async def get_me(current_user: User = Depends(get_current_user)):
+async def get_me(current_user: User = Depends(get_current_user_record)):
     return current_user
 
+@api_router.post("/auth/logout-all", response_model=TokenResponse)
+async def logout_all_sessions(current_user: User = Depends(get_current_user_record)):
+    """Revoke every token issued so far and hand back a fresh one for this device"""
+    user_doc = await db.users.find_one_and_update(
+        {"id": current_user.id},
+        {"$inc": {"token_version": 1}},
+        return_document=ReturnDocument.AFTER
+    )
+    token_verifier.revoke(current_user.id, user_doc['token_version'])
+    
+    access_token = issue_access_token(current_user, user_doc['token_version'])
+    
+    return TokenResponse(access_token=access_token, user=current_user)
+
 
 # ============ SHOPKEEPER ROUTES ============
 
@@ -239,7 +2098,7 @@ async def update_shopkeeper_profile(
     cashback_offer: str = Form(...),
     store_description: Optional[str] = Form(""),
     promotional_image: Optional[UploadFile] = File(None),
-    current_user: User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     if current_user.role != 'shopkeeper':
         raise HTTPException(status_code=403, detail="Only shopkeepers can update profile")
@@ -281,59 +2140,105 @@ async def update_shopkeeper_profile(
     else:
         await db.shopkeeper_profiles.insert_one(profile_data)
     
+    # Other workers hear about this through the change stream
+    cache_invalidator.publish("shopkeeper_profiles", profile_data)
+    await job_queue.enqueue("render_share_card", {"shopkeeper_id": current_user.id})
+    
     return {"message": "Profile updated successfully"}
 
 @api_router.get("/shopkeeper/profile")
-async def get_shopkeeper_profile(current_user: User = Depends(get_current_user)):
+async def get_shopkeeper_profile(current_user: CurrentUser = Depends(get_current_user)):
     if current_user.role != 'shopkeeper':
         raise HTTPException(status_code=403, detail="Only shopkeepers can view profile")
     
-    profile = await db.shopkeeper_profiles.find_one({"shopkeeper_id": current_user.id}, {"_id": 0})
+    profile = await find_profile(current_user.id)
     if not profile:
         return None
     
     return profile
 
 @api_router.delete("/shopkeeper/profile")
-async def delete_shopkeeper_profile(current_user: User = Depends(get_current_user)):
+async def delete_shopkeeper_profile(current_user: CurrentUser = Depends(get_current_user)):
     if current_user.role != 'shopkeeper':
         raise HTTPException(status_code=403, detail="Only shopkeepers can delete profile")
     
-    # Delete profile
-    await db.shopkeeper_profiles.delete_one({"shopkeeper_id": current_user.id})
-    
-    # Delete all coupons associated with this shopkeeper
-    await db.coupons.delete_many({"shopkeeper_id": current_user.id})
+    # Queue the job first: if this request dies partway through, the job still finishes the deletion
+    job_id = await enqueue_shopkeeper_deletion(current_user.id)
     
-    # Delete user account
-    await db.users.delete_one({"id": current_user.id})
+    # Mark the account deleted right away so it can no longer log in or show up in the directory
+    await db.users.update_one(
+        {"id": current_user.id},
+        {"$set": {"deleted_at": datetime.now(timezone.utc).isoformat()}}
+    )
     
-    return {"message": "Profile deleted successfully"}
+    # Delete profile
+    await db.shopkeeper_profiles.delete_one({"shopkeeper_id": current_user.id})
+    await db.share_cards.delete_one({"shopkeeper_id": current_user.id})
+    cache_invalidator.publish("users", {"id": current_user.id})
+    cache_invalidator.publish("shopkeeper_profiles", {"shopkeeper_id": current_user.id})
+    cache_invalidator.publish("share_cards", {"shopkeeper_id": current_user.id})
+    token_verifier.revoke(current_user.id, math.inf)
+    
+    # Coupons and the user document are removed in the background by the deletion worker
+    return {"message": "Profile deleted successfully", "job_id": job_id}
+
+@api_router.get("/jobs/deletion/{job_id}")
+async def get_deletion_job(job_id: str):
+    """Progress of a queued shopkeeper deletion"""
+    # Anyone with the job id can poll it, so it doesn't say whose store it was
+    job = await db.deletion_jobs.find_one({"id": job_id}, {"_id": 0, "locked_until": 0, "shopkeeper_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Deletion job not found")
+    
+    return job
 
 @api_router.get("/shopkeeper/coupons")
-async def get_shopkeeper_coupons(current_user: User = Depends(get_current_user)):
+async def get_shopkeeper_coupons(current_user: CurrentUser = Depends(get_current_user)):
     if current_user.role != 'shopkeeper':
         raise HTTPException(status_code=403, detail="Only shopkeepers can view coupons")
     
-    coupons = await db.coupons.find({"shopkeeper_id": current_user.id}, {"_id": 0}).to_list(1000)
+    coupons = await db.coupons.find({"shopkeeper_id": current_user.id}, {"_id": 0, "expires_at": 0}).to_list(1000)
+    coupons += await db.coupons_archive.find({"shopkeeper_id": current_user.id}, {"_id": 0}).to_list(1000)
     
-    # Get customer details for each coupon
+    # Get customer details for all coupons in one query
+    usernames = await lookup_usernames(coupon['customer_id'] for coupon in coupons)
     for coupon in coupons:
-        customer = await db.users.find_one({"id": coupon['customer_id']}, {"_id": 0, "username": 1})
-        coupon['customer_username'] = customer['username'] if customer else 'Unknown'
+        coupon['customer_username'] = usernames.get(coupon['customer_id'], 'Unknown')
     
     return coupons
 
+@api_router.get("/shopkeeper/coupons/export")
+async def export_shopkeeper_coupons(
+    export_format: str = Query("csv", alias="format"),
+    current_user: CurrentUser = Depends(get_current_user)
+):
+    """Stream every coupon for the store, including archived ones, as CSV or Parquet"""
+    if current_user.role != 'shopkeeper':
+        raise HTTPException(status_code=403, detail="Only shopkeepers can export coupons")
+    
+    if export_format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="Export format must be csv or parquet")
+    if export_format == "parquet" and not parquet_available():
+        raise HTTPException(status_code=400, detail="Parquet export is not available on this server")
+    
+    filename = f"coupons-{datetime.now(timezone.utc).strftime('%Y%m%d')}.{export_format}"
+    return StreamingResponse(
+        stream_coupon_export(current_user.id, export_format),
+        media_type=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
 @api_router.get("/shopkeeper/analytics")
-async def get_shopkeeper_analytics(current_user: User = Depends(get_current_user)):
+async def get_shopkeeper_analytics(current_user: CurrentUser = Depends(get_current_user)):
     if current_user.role != 'shopkeeper':
         raise HTTPException(status_code=403, detail="Only shopkeepers can view analytics")
     
-    # Get all coupons
-    all_coupons = await db.coupons.find({"shopkeeper_id": current_user.id}).to_list(1000)
-    
-    total_coupons = len(all_coupons)
-    redeemed_coupons = sum(1 for c in all_coupons if c['is_redeemed'])
+    # Archived coupons are all redeemed, so they only need counting
+    archived_coupons = await db.coupons_archive.count_documents({"shopkeeper_id": current_user.id})
+    total_coupons = await db.coupons.count_documents({"shopkeeper_id": current_user.id}) + archived_coupons
+    redeemed_coupons = await db.coupons.count_documents(
+        {"shopkeeper_id": current_user.id, "is_redeemed": True}
+    ) + archived_coupons
     pending_coupons = total_coupons - redeemed_coupons
     
     return {
@@ -343,44 +2248,80 @@ async def get_shopkeeper_analytics(current_user: User = Depends(get_current_user
     }
 
 
+@api_router.get("/shopkeeper/report")
+async def get_shopkeeper_report(current_user: CurrentUser = Depends(get_current_user)):
+    """This store's numbers from the latest offline analytics report, next to the platform averages"""
+    if current_user.role != 'shopkeeper':
+        raise HTTPException(status_code=403, detail="Only shopkeepers can view reports")
+    
+    summary = await db.reports.find_one({"kind": "summary"}, {"_id": 0}, sort=[("generated_at", -1)])
+    if not summary:
+        raise HTTPException(status_code=404, detail="No report has been generated yet")
+    
+    store = await db.reports.find_one(
+        {"report_id": summary['report_id'], "kind": "store", "shopkeeper_id": current_user.id},
+        {"_id": 0, "report_id": 0, "kind": 0, "shopkeeper_id": 0}
+    )
+    
+    return {
+        "generated_at": summary['generated_at'],
+        "store": store,
+        "platform": {
+            "redemption_rate": summary['redemption_rate'],
+            "share_to_redeem_rate": summary['share_to_redeem_rate'],
+            "time_to_redeem_hours": summary['time_to_redeem_hours'],
+        }
+    }
+
+
 # ============ CUSTOMER ROUTES ============
 
 @api_router.post("/customer/coupon", response_model=Coupon)
 async def create_coupon(
     coupon_create: CouponCreate,
-    current_user: User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
     if current_user.role != 'customer':
         raise HTTPException(status_code=403, detail="Only customers can create coupons")
     
     # Verify shopkeeper exists
-    shopkeeper = await db.users.find_one({"id": coupon_create.shopkeeper_id, "role": "shopkeeper"})
+    shopkeeper = await db.users.find_one(
+        {"id": coupon_create.shopkeeper_id, "role": "shopkeeper", "deleted_at": {"$exists": False}}
+    )
     if not shopkeeper:
         raise HTTPException(status_code=404, detail="Shopkeeper not found")
     
-    # Create coupon
-    coupon = Coupon(
-        customer_id=current_user.id,
-        shopkeeper_id=coupon_create.shopkeeper_id
-    )
-    
-    coupon_dict = coupon.model_dump()
-    coupon_dict['created_at'] = coupon_dict['created_at'].isoformat()
-    
-    await db.coupons.insert_one(coupon_dict)
+    async def insert_coupon():
+        coupon = Coupon(
+            customer_id=current_user.id,
+            shopkeeper_id=coupon_create.shopkeeper_id
+        )
+        
+        coupon_dict = coupon.model_dump()
+        coupon_dict['created_at'] = coupon_dict['created_at'].isoformat()
+        
+        await db.coupons.insert_one(coupon_dict)
+        remember_coupon_code(coupon.coupon_code)
+        
+        return coupon.model_dump(mode="json")
     
-    return coupon
+    # Create coupon, once per Idempotency-Key so client retries don't mint duplicates
+    return await run_idempotent(
+        f"customer-coupon:{current_user.id}", idempotency_key, coupon_create.shopkeeper_id, insert_coupon
+    )
 
 @api_router.get("/customer/coupons")
-async def get_customer_coupons(current_user: User = Depends(get_current_user)):
+async def get_customer_coupons(current_user: CurrentUser = Depends(get_current_user)):
     if current_user.role != 'customer':
         raise HTTPException(status_code=403, detail="Only customers can view coupons")
     
     coupons = await db.coupons.find({"customer_id": current_user.id}, {"_id": 0}).to_list(1000)
+    coupons += await db.coupons_archive.find({"customer_id": current_user.id}, {"_id": 0}).to_list(1000)
     
     # Get shopkeeper details for each coupon
     for coupon in coupons:
-        profile = await db.shopkeeper_profiles.find_one({"shopkeeper_id": coupon['shopkeeper_id']}, {"_id": 0})
+        profile = await find_profile(coupon['shopkeeper_id'])
         if profile:
             coupon['store_name'] = profile.get('store_name', 'Unknown Store')
             coupon['cashback_offer'] = profile.get('cashback_offer', 'No offer')
@@ -390,13 +2331,14 @@ async def get_customer_coupons(current_user: User = Depends(get_current_user)):
 @api_router.post("/customer/click")
 async def track_click(
     click_req: ClickTrackRequest,
-    current_user: User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     if current_user.role != 'customer':
         raise HTTPException(status_code=403, detail="Only customers can track clicks")
     
     # Find coupon
-    coupon = await db.coupons.find_one({"coupon_code": click_req.coupon_code, "customer_id": current_user.id})
+    coupon = await find_coupon({"coupon_code": click_req.coupon_code, "customer_id": current_user.id},
+                               trust_filter=False)
     if not coupon:
         raise HTTPException(status_code=404, detail="Coupon not found")
     
@@ -410,6 +2352,7 @@ async def track_click(
         {"coupon_code": click_req.coupon_code},
         {"$set": {"click_count": new_click_count}}
     )
+    cache_invalidator.publish("coupons", {"coupon_code": click_req.coupon_code})
     
     return {
         "message": "Click tracked successfully",
@@ -421,13 +2364,14 @@ async def track_click(
 @api_router.post("/customer/redeem")
 async def redeem_coupon(
     click_req: ClickTrackRequest,
-    current_user: User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     if current_user.role != 'customer':
         raise HTTPException(status_code=403, detail="Only customers can redeem coupons")
     
     # Find coupon
-    coupon = await db.coupons.find_one({"coupon_code": click_req.coupon_code, "customer_id": current_user.id})
+    coupon = await find_coupon({"coupon_code": click_req.coupon_code, "customer_id": current_user.id},
+                               trust_filter=False)
     if not coupon:
         raise HTTPException(status_code=404, detail="Coupon not found")
     
@@ -438,8 +2382,8 @@ async def redeem_coupon(
     if coupon['click_count'] < 3:
         raise HTTPException(status_code=400, detail="You need to click Copy Link 3 times before redeeming")
     
-    # Get shopkeeper profile for cashback offer
-    profile = await db.shopkeeper_profiles.find_one({"shopkeeper_id": coupon['shopkeeper_id']})
+    # Get shopkeeper profile for cashback offer (cached, invalidated on every profile change)
+    profile = await find_profile(coupon['shopkeeper_id'])
     cashback_offer = profile.get('cashback_offer', 'No offer') if profile else 'No offer'
     
     # Redeem coupon
@@ -449,8 +2393,9 @@ async def redeem_coupon(
             "is_redeemed": True,
             "cashback_earned": cashback_offer,
             "redeemed_at": datetime.now(timezone.utc).isoformat()
-        }}
+        }, "$unset": {"expires_at": ""}}
     )
+    cache_invalidator.publish("coupons", {"coupon_code": click_req.coupon_code})
     
     return {
         "message": "Coupon redeemed successfully",
@@ -461,18 +2406,7 @@ async def redeem_coupon(
 
 # ============ PUBLIC ROUTES ============
 
-@api_router.get("/public/coupon/{coupon_code}")
-async def get_public_coupon(coupon_code: str):
-    """Public endpoint to view coupon details (for shared links)"""
-    coupon = await db.coupons.find_one({"coupon_code": coupon_code}, {"_id": 0})
-    if not coupon:
-        raise HTTPException(status_code=404, detail="Coupon not found")
-    
-    # Get shopkeeper profile
-    profile = await db.shopkeeper_profiles.find_one({"shopkeeper_id": coupon['shopkeeper_id']}, {"_id": 0})
-    if not profile:
-        raise HTTPException(status_code=404, detail="Store information not found")
-    
+def public_coupon_response(coupon: dict, profile: dict) -> dict:
     return {
         "coupon_code": coupon['coupon_code'],
         "store_name": profile.get('store_name', 'Store'),
@@ -482,15 +2416,75 @@ async def get_public_coupon(coupon_code: str):
         "is_redeemed": coupon['is_redeemed']
     }
 
+def last_known_public_coupon(params: dict):
+    coupon = public_coupon_cache.last_known(params["coupon_code"])
+    store = shopkeeper_info_cache.last_known(coupon['shopkeeper_id']) if coupon else None
+    if store is None:
+        return None
+    return PrefixedSnapshot({"coupon_code": coupon['coupon_code'], "is_redeemed": coupon['is_redeemed']}, store)
+
+@api_router.get("/public/coupon/{coupon_code}")
+@serves_stale(last_known_public_coupon)
+async def get_public_coupon(coupon_code: str, request: Request):
+    """Public endpoint to view coupon details (for shared links)"""
+    # Every QR visit mints a new code, so only the coupon's own fields are cached per code
+    # and the store part, with its image, is shared through shopkeeper_info_cache
+    coupon = public_coupon_cache.get(coupon_code)
+    if coupon is CACHE_MISS:
+        generation = public_coupon_cache.generation
+        found = await find_coupon(
+            {"coupon_code": coupon_code},
+            {"_id": 0, "coupon_code": 1, "shopkeeper_id": 1, "is_redeemed": 1},
+            public=True
+        )
+        if not found:
+            raise HTTPException(status_code=404, detail="Coupon not found")
+        coupon = {"coupon_code": found['coupon_code'], "shopkeeper_id": found['shopkeeper_id'],
+                  "is_redeemed": found['is_redeemed']}
+        public_coupon_cache.set(coupon_code, coupon, generation, stale=public_db is not db)
+    
+    # Get shopkeeper profile
+    store = await find_store_snapshot(coupon['shopkeeper_id'])
+    if store is None:
+        raise HTTPException(status_code=404, detail="Store information not found")
+    
+    return PrefixedSnapshot({"coupon_code": coupon['coupon_code'], "is_redeemed": coupon['is_redeemed']}, store) \
+        .response(request)
+
 @api_router.get("/public/shopkeepers")
-async def get_all_shopkeepers():
+@serves_stale(lambda params: directory_cache.last_known("all"))
+async def get_all_shopkeepers(request: Request):
     """Get list of all shopkeepers for customer to choose from"""
-    shopkeepers = await db.users.find({"role": "shopkeeper"}, {"_id": 0, "password": 0}).to_list(1000)
-    
-    # Get profiles for each shopkeeper
+    snapshot = directory_cache.get("all")
+    if snapshot is CACHE_MISS:
+        snapshot = await read_flight.do(("directory",), build_shopkeeper_directory)
+    return snapshot.response(request)
+
+async def build_shopkeeper_directory():
+    generation = directory_cache.generation
+    shopkeepers = await public_db.users.find(
+        {"role": "shopkeeper", "deleted_at": {"$exists": False}}, {"_id": 0, "id": 1, "username": 1}
+    ).to_list(1000)
+
+    # Only the listed fields: full profiles carry base64 images and the directory is cached whole
+    async def fetch(source, shopkeeper_ids):
+        return {
+            p['shopkeeper_id']: p
+            for p in await source.shopkeeper_profiles.find(
+                {"shopkeeper_id": {"$in": shopkeeper_ids}},
+                {"_id": 0, "shopkeeper_id": 1, "store_name": 1, "cashback_offer": 1}
+            ).to_list(len(shopkeeper_ids))
+        }
+
+    shopkeeper_ids = [shopkeeper['id'] for shopkeeper in shopkeepers]
+    profiles = await fetch(public_db, shopkeeper_ids)
+    # Possibly stores that signed up after the secondary's last sync
+    unsynced = [shopkeeper_id for shopkeeper_id in shopkeeper_ids if shopkeeper_id not in profiles]
+    if unsynced and public_db is not db:
+        profiles.update(await fetch(db, unsynced))
     result = []
     for shopkeeper in shopkeepers:
-        profile = await db.shopkeeper_profiles.find_one({"shopkeeper_id": shopkeeper['id']}, {"_id": 0})
+        profile = profiles.get(shopkeeper['id'])
         result.append({
             "id": shopkeeper['id'],
             "username": shopkeeper['username'],
@@ -498,15 +2492,11 @@ async def get_all_shopkeepers():
             "cashback_offer": profile.get('cashback_offer', 'No offer') if profile else 'No offer'
         })
     
-    return result
+    snapshot = Snapshot(result)
+    directory_cache.set("all", snapshot, generation, stale=public_db is not db)
+    return snapshot
 
-@api_router.get("/public/shopkeeper/{shopkeeper_id}")
-async def get_shopkeeper_info(shopkeeper_id: str):
-    """Get shopkeeper info by ID"""
-    profile = await db.shopkeeper_profiles.find_one({"shopkeeper_id": shopkeeper_id}, {"_id": 0})
-    if not profile:
-        raise HTTPException(status_code=404, detail="Shopkeeper not found")
-    
+def shopkeeper_info_response(profile: dict) -> dict:
     return {
         "store_name": profile.get('store_name', 'Store'),
         "cashback_offer": profile.get('cashback_offer', 'No offer'),
@@ -514,31 +2504,73 @@ async def get_shopkeeper_info(shopkeeper_id: str):
         "promotional_image": profile.get('promotional_image', None)
     }
 
-@api_router.post("/public/generate-coupon")
-async def generate_coupon_public(data: dict):
+def last_known_shopkeeper_info(params: dict):
+    snapshot = shopkeeper_info_cache.last_known(params["shopkeeper_id"])
+    if snapshot is not None:
+        return snapshot
+    profile = profile_cache.last_known(params["shopkeeper_id"])
+    return shopkeeper_info_response(profile) if profile else None
+
+async def find_store_snapshot(shopkeeper_id: str) -> Optional[Snapshot]:
+    """A store's public page body, serialized and compressed once per profile change"""
+    cached = shopkeeper_info_cache.get(shopkeeper_id)
+    if cached is not CACHE_MISS:
+        return cached
+    generation = shopkeeper_info_cache.generation
+    
+    profile = await find_profile(shopkeeper_id, public=True)
+    if not profile:
+        return None
+    
+    # Mostly the base64 promotional image, worth compressing once rather than per request
+    snapshot = Snapshot(shopkeeper_info_response(profile))
+    shopkeeper_info_cache.set(shopkeeper_id, snapshot, generation, stale=public_db is not db)
+    return snapshot
+
+@api_router.get("/public/shopkeeper/{shopkeeper_id}")
+@serves_stale(last_known_shopkeeper_info)
+async def get_shopkeeper_info(shopkeeper_id: str, request: Request):
+    """Get shopkeeper info by ID"""
+    snapshot = await find_store_snapshot(shopkeeper_id)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="Shopkeeper not found")
+    return snapshot.response(request)
+
+@api_router.post("/public/generate-coupon", dependencies=[Depends(rate_limit("generate-coupon"))])
+async def generate_coupon_public(
+    data: dict,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
     """Generate coupon without login - no customer data required"""
     shopkeeper_id = data.get('shopkeeper_id')
     
     if not shopkeeper_id:
         raise HTTPException(status_code=400, detail="Shopkeeper ID required")
     
-    # Create new anonymous coupon with unique ID
-    anonymous_customer_id = f"anonymous_{uuid.uuid4().hex[:12]}"
-    
-    coupon = Coupon(
-        customer_id=anonymous_customer_id,
-        shopkeeper_id=shopkeeper_id
-    )
-    
-    coupon_dict = coupon.model_dump()
-    coupon_dict['created_at'] = coupon_dict['created_at'].isoformat()
-    coupon_dict['share_clicked'] = False  # Track if WhatsApp share was clicked
-    
-    await db.coupons.insert_one(coupon_dict)
+    async def insert_coupon():
+        # Create new anonymous coupon with unique ID
+        anonymous_customer_id = f"anonymous_{uuid.uuid4().hex[:12]}"
+        
+        coupon = Coupon(
+            customer_id=anonymous_customer_id,
+            shopkeeper_id=shopkeeper_id
+        )
+        
+        coupon_dict = coupon.model_dump()
+        coupon_dict['created_at'] = coupon_dict['created_at'].isoformat()
+        coupon_dict['share_clicked'] = False  # Track if WhatsApp share was clicked
+        expires_at = anonymous_coupon_expiry()
+        if expires_at:
+            coupon_dict['expires_at'] = expires_at  # Cleared once shared, otherwise the TTL index removes it
+        
+        await db.coupons.insert_one(coupon_dict)
+        remember_coupon_code(coupon.coupon_code)
+        
+        return coupon.model_dump(mode="json")
     
-    return coupon
+    return await run_idempotent("generate-coupon", idempotency_key, str(shopkeeper_id), insert_coupon)
 
-@api_router.post("/public/track-share")
+@api_router.post("/public/track-share", dependencies=[Depends(rate_limit("track-share"))])
 async def track_whatsapp_share(data: dict):
     """Track WhatsApp share button click"""
     coupon_code = data.get('coupon_code')
@@ -546,7 +2578,7 @@ async def track_whatsapp_share(data: dict):
     if not coupon_code:
         raise HTTPException(status_code=400, detail="Coupon code required")
     
-    coupon = await db.coupons.find_one({"coupon_code": coupon_code})
+    coupon = await find_coupon({"coupon_code": coupon_code}, trust_filter=False)
     if not coupon:
         raise HTTPException(status_code=404, detail="Coupon not found")
     
@@ -556,8 +2588,10 @@ async def track_whatsapp_share(data: dict):
     # Mark that share button was clicked
     await db.coupons.update_one(
         {"coupon_code": coupon_code},
-        {"$set": {"share_clicked": True}}
+        {"$set": {"share_clicked": True, "shared_at": datetime.now(timezone.utc).isoformat()},
+         "$unset": {"expires_at": ""}}
     )
+    cache_invalidator.publish("coupons", {"coupon_code": coupon_code})
     
     return {
         "message": "Share tracked successfully",
@@ -566,15 +2600,15 @@ async def track_whatsapp_share(data: dict):
         "is_redeemed": False
     }
 
-@api_router.post("/public/redeem-coupon")
-async def redeem_coupon_public(data: dict):
+@api_router.post("/public/redeem-coupon", dependencies=[Depends(rate_limit("redeem-coupon"))])
+async def redeem_coupon_public(data: dict, request: Request):
     """Redeem coupon without login"""
     coupon_code = data.get('coupon_code')
     
     if not coupon_code:
         raise HTTPException(status_code=400, detail="Coupon code required")
     
-    coupon = await db.coupons.find_one({"coupon_code": coupon_code})
+    coupon = await find_coupon({"coupon_code": coupon_code}, trust_filter=False)
     if not coupon:
         raise HTTPException(status_code=404, detail="Coupon not found")
     
@@ -584,19 +2618,33 @@ async def redeem_coupon_public(data: dict):
     if not coupon.get('share_clicked', False):
         raise HTTPException(status_code=400, detail="You need to share via WhatsApp before redeeming")
     
-    # Get shopkeeper profile for cashback offer
-    profile = await db.shopkeeper_profiles.find_one({"shopkeeper_id": coupon['shopkeeper_id']})
+    # Get shopkeeper profile for cashback offer (cached, invalidated on every profile change)
+    profile = await find_profile(coupon['shopkeeper_id'])
     cashback_offer = profile.get('cashback_offer', 'No offer') if profile else 'No offer'
     
     # Redeem coupon
+    redeemed_at = datetime.now(timezone.utc)
     await db.coupons.update_one(
         {"coupon_code": coupon_code},
         {"$set": {
             "is_redeemed": True,
             "cashback_earned": cashback_offer,
-            "redeemed_at": datetime.now(timezone.utc).isoformat()
-        }}
+            "redeemed_at": redeemed_at.isoformat()
+        }, "$unset": {"expires_at": ""}}
     )
+    cache_invalidator.publish("coupons", {"coupon_code": coupon_code})
+    
+    # Scored asynchronously, this only puts the event on an in-memory queue
+    shared_at = coupon.get('shared_at')
+    fraud_scorer.submit({
+        "coupon_code": coupon_code,
+        "shopkeeper_id": coupon['shopkeeper_id'],
+        "ip": get_client_ip(request),
+        "timestamp": redeemed_at.timestamp(),
+        "share_to_redeem_seconds": (
+            (redeemed_at - datetime.fromisoformat(shared_at)).total_seconds() if shared_at else None
+        ),
+    })
     
     return {
         "message": "Coupon redeemed successfully",
@@ -605,13 +2653,202 @@ async def redeem_coupon_public(data: dict):
     }
 
 
+@api_router.get("/share/{shopkeeper_id}/preview.jpg")
+async def get_share_image(shopkeeper_id: str):
+    """Preview image for link unfurls, versioned through the ?v= in the share page"""
+    if not FRONTEND_URL:
+        raise HTTPException(status_code=404, detail="Share links are not configured")
+    card = await find_share_card(shopkeeper_id)
+    # Cards rendered before uploads were limited to raster types may still hold anything
+    if not card or not card.get('image') or card['image_type'] not in SHARE_IMAGE_TYPES:
+        raise HTTPException(status_code=404, detail="No preview image")
+    return Response(
+        content=card['image'],
+        media_type=card['image_type'],
+        headers={
+            "Cache-Control": "public, max-age=31536000, immutable",
+            "ETag": f'"{card["version"]}"',
+            "X-Content-Type-Options": "nosniff",
+        }
+    )
+
+@api_router.get("/share/{shopkeeper_id}/{coupon_code}", response_class=HTMLResponse)
+async def get_share_page(shopkeeper_id: str, coupon_code: str, request: Request):
+    """Share link with Open Graph tags for link previews, sending people on to the coupon page.
+    
+    The coupon code isn't looked up, an unknown one simply lands on the app's not-found page.
+    """
+    if not FRONTEND_URL:
+        raise HTTPException(status_code=404, detail="Share links are not configured")
+    card = await find_share_card(shopkeeper_id)
+    if not card:
+        raise HTTPException(status_code=404, detail="Store not found")
+    
+    coupon_url = html.escape(f"{FRONTEND_URL}/#/coupon/{quote(coupon_code, safe='')}")
+    head = [card['meta_html'], f'<meta property="og:url" content="{coupon_url}">']
+    if card.get('image') and card['image_type'] in SHARE_IMAGE_TYPES:
+        image_url = html.escape(
+            f"{str(request.base_url).rstrip('/')}/api/share/{quote(shopkeeper_id, safe='')}/preview.jpg?v={card['version']}"
+        )
+        head += [
+            f'<meta property="og:image" content="{image_url}">',
+            f'<meta property="og:image:type" content="{html.escape(card["image_type"])}">',
+        ]
+        if card.get('image_size'):
+            head += [
+                f'<meta property="og:image:width" content="{card["image_size"][0]}">',
+                f'<meta property="og:image:height" content="{card["image_size"][1]}">',
+            ]
+    head.append(f'<meta http-equiv="refresh" content="0; url={coupon_url}">')
+    page = (
+        '<!DOCTYPE html>\n<html><head>\n<meta charset="utf-8">\n'
+        + "\n".join(head)
+        + f'\n</head><body><a href="{coupon_url}">Open your coupon</a></body></html>'
+    )
+    return HTMLResponse(page, headers={"Cache-Control": "public, max-age=300"})
+
+
+# ============ BATCH ROUTES ============
+
+@api_router.post("/batch", dependencies=[Depends(rate_limit("batch"))])
+async def run_batch(
+    batch: BatchRequest,
+    request: Request,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
+):
+    """Run several coupon lookups, shares and clicks with one read and one bulk write.
+    
+    Every operation is checked against the coupons as they were before this batch's
+    writes, and gets its own status in the results list.
+    """
+    operations = batch.operations
+    
+    # Only clicks need a logged-in customer
+    current_user = None
+    auth_error = None
+    if any(op.op == "click" for op in operations):
+        if credentials is None:
+            auth_error = HTTPException(status_code=401, detail="Not authenticated")
+        else:
+            try:
+                current_user = await get_current_user(credentials)
+            except HTTPException as e:
+                auth_error = e
+    
+    # One read for every coupon in the batch, plus one for any that were archived.
+    # Only codes that are just looked up may be rejected by the coupon code filter
+    written = {op.coupon_code for op in operations if op.op != "coupon"}
+    codes = [
+        code for code in {op.coupon_code for op in operations}
+        if not coupon_code_missing(code, trust_filter=code not in written)
+    ]
+    coupons = {}
+    generation = missing_coupon_cache.generation
+    if codes:
+        for c in await db.coupons.find({"coupon_code": {"$in": codes}}, {"_id": 0}).to_list(len(codes)):
+            coupons[c['coupon_code']] = c
+    missing = [code for code in codes if code not in coupons]
+    if missing:
+        for c in await db.coupons_archive.find({"coupon_code": {"$in": missing}}, {"_id": 0}).to_list(len(missing)):
+            coupons[c['coupon_code']] = c
+    for code in missing:
+        if code not in coupons:
+            missing_coupon_cache.set(code, True, generation)
+    profiles = await find_profiles(
+        coupons[op.coupon_code]['shopkeeper_id']
+        for op in operations if op.op == "coupon" and op.coupon_code in coupons
+    )
+    
+    share_rules = get_rate_limit_rules("track-share")
+    client_ip = get_client_ip(request)
+    shared_codes = set()
+    clicks = {}
+    results = []
+    for op in operations:
+        coupon = coupons.get(op.coupon_code)
+        try:
+            if op.op == "coupon":
+                if not coupon:
+                    raise HTTPException(status_code=404, detail="Coupon not found")
+                profile = profiles.get(coupon['shopkeeper_id'])
+                if not profile:
+                    raise HTTPException(status_code=404, detail="Store information not found")
+                body = public_coupon_response(coupon, profile)
+            
+            elif op.op == "share":
+                await enforce_rate_limit("track-share", share_rules, {"ip": client_ip, "coupon": op.coupon_code})
+                if not coupon:
+                    raise HTTPException(status_code=404, detail="Coupon not found")
+                if coupon['is_redeemed']:
+                    body = {"message": "Coupon already redeemed", "already_redeemed": True, "share_clicked": True}
+                else:
+                    shared_codes.add(op.coupon_code)
+                    body = {"message": "Share tracked successfully", "share_clicked": True,
+                            "can_redeem": True, "is_redeemed": False}
+            
+            elif op.op == "click":
+                if auth_error:
+                    raise auth_error
+                if current_user.role != 'customer':
+                    raise HTTPException(status_code=403, detail="Only customers can track clicks")
+                if not coupon or coupon['customer_id'] != current_user.id:
+                    raise HTTPException(status_code=404, detail="Coupon not found")
+                if coupon['is_redeemed']:
+                    body = {"message": "Coupon already redeemed", "already_redeemed": True,
+                            "click_count": coupon['click_count']}
+                else:
+                    clicks[op.coupon_code] = clicks.get(op.coupon_code, 0) + 1
+                    new_click_count = coupon['click_count'] + clicks[op.coupon_code]
+                    body = {"message": "Click tracked successfully", "click_count": new_click_count,
+                            "can_redeem": new_click_count >= 3, "is_redeemed": False}
+            
+            else:
+                raise HTTPException(status_code=400, detail=f"Unknown operation: {op.op}")
+            
+            results.append({"status": 200, "body": body})
+        except HTTPException as e:
+            results.append({"status": e.status_code, "detail": e.detail})
+    
+    # One bulk write for every share and click in the batch
+    shared_at = datetime.now(timezone.utc).isoformat()
+    writes = [
+        UpdateOne({"coupon_code": code}, {"$set": {"share_clicked": True, "shared_at": shared_at},
+                                          "$unset": {"expires_at": ""}})
+        for code in shared_codes
+    ] + [
+        UpdateOne({"coupon_code": code}, {"$inc": {"click_count": count}})
+        for code, count in clicks.items()
+    ]
+    if writes:
+        await db.coupons.bulk_write(writes, ordered=False)
+        for code in shared_codes | set(clicks):
+            cache_invalidator.publish("coupons", {"coupon_code": code})
+    
+    return {"results": results}
+
+
 @api_router.get("/")
 async def root():
     return {"message": "Referral Coupon System API"}
 
 
 # Include the router in the main app
-app.include_router(api_router)
+app.include_router(api_router, dependencies=[Depends(guard_database)])
+app.add_exception_handler(DatabaseUnavailable, database_unavailable_handler)
+for error in MONGO_UNAVAILABLE_ERRORS:
+    app.add_exception_handler(error, database_unavailable_handler)
+
+@app.get("/metrics")
+async def metrics():
+    """Process-local health numbers, outside /api so they stay reachable while Mongo is down"""
+    return {
+        "mongo_circuit_breaker": circuit_breaker.snapshot(),
+        "fraud_events_dropped": fraud_scorer.dropped,
+        "jobs": job_queue.snapshot(),
+        "coupon_code_filter": coupon_code_filter.snapshot(),
+    }
+
+app.add_middleware(CompressionMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -628,6 +2865,38 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Long-running loops started on startup, cancelled on shutdown
+background_tasks = []
+
+@app.on_event("startup")
+async def startup_tasks():
+    if not FRONTEND_URL:
+        # Share pages would redirect to a relative URL on the API host
+        logger.warning("FRONTEND_URL is not set, share links with previews (/api/share/...) are disabled")
+    if isinstance(rate_limit_backend, MongoRateLimitBackend):
+        await rate_limit_backend.ensure_indexes()
+    await ensure_coupon_indexes()
+    await ensure_idempotency_indexes()
+    await job_queue.ensure_indexes()
+    await db.deletion_jobs.create_index("id", unique=True)
+    await db.deletion_jobs.create_index([("status", 1), ("created_at", 1)])
+    await db.revoked_users.create_index("expires_at", expireAfterSeconds=0)
+    # For TokenVerifier.refresh: only the few revoked or deleted users are indexed
+    await db.users.create_index("token_version", partialFilterExpression={"token_version": {"$gt": 0}})
+    await db.users.create_index("deleted_at", partialFilterExpression={"deleted_at": {"$exists": True}})
+    background_tasks.append(asyncio.create_task(coupon_sweeper()))
+    background_tasks.append(asyncio.create_task(deletion_worker()))
+    background_tasks.append(asyncio.create_task(cache_invalidator.listen()))
+    background_tasks.append(asyncio.create_task(coupon_code_filter.maintainer()))
+    background_tasks.append(asyncio.create_task(token_verifier.refresher()))
+    for _ in range(FRAUD_WORKERS):
+        background_tasks.append(asyncio.create_task(fraud_scorer.worker()))
+    background_tasks.append(asyncio.create_task(job_queue.poller()))
+    for _ in range(JOB_WORKERS):
+        background_tasks.append(asyncio.create_task(job_queue.worker()))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
     client.close()
\ No newline at end of file
@@ -4,3 +4,21 @@ import { twMerge } from "tailwind-merge"
 export function cn(...inputs) {
   return twMerge(clsx(inputs));
 }
+
+// One key per user action, sent as Idempotency-Key so a retried or repeated
+// request doesn't create a second coupon. randomUUID needs a secure context.
+export function newIdempotencyKey() {
+  if (window.crypto?.randomUUID) {
+    return window.crypto.randomUUID();
+  }
+  return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}${Math.random().toString(36).slice(2)}`;
+}
+
+// Share links go through the backend's /share page, which adds link-preview tags, once it
+// knows the frontend's address (FRONTEND_URL); otherwise straight to the coupon page.
+export function couponShareLink(api, shopkeeperId, couponCode) {
+  if (process.env.REACT_APP_SHARE_PREVIEWS === 'true') {
+    return `${api}/share/${shopkeeperId}/${couponCode}`;
+  }
+  return `${window.location.origin}/#/coupon/${couponCode}`;
+}
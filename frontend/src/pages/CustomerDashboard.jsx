@@ -1,4 +1,4 @@
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import { useLocation } from "react-router-dom";
 import axios from "axios";
 import { Button } from "@/components/ui/button";
@@ -9,6 +9,7 @@ import { LogOut, Copy, Gift, CheckCircle, Clock } from "lucide-react";
 import { toast } from "sonner";
 import { Dialog, DialogContent, DialogDescription, DialogHeader, DialogTitle } from "@/components/ui/dialog";
 import AdsterraAd from "@/components/AdsterraAd";
+import { couponShareLink, newIdempotencyKey } from "@/lib/utils";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
@@ -26,6 +27,7 @@ const CustomerDashboard = ({ user, onLogout }) => {
   const [showCongrats, setShowCongrats] = useState(false);
   const [redeemedCoupon, setRedeemedCoupon] = useState(null);
   const [redeemEnabled, setRedeemEnabled] = useState({});
+  const createKey = useRef(null);
 
   useEffect(() => {
     fetchShopkeepers();
@@ -68,11 +70,18 @@ const CustomerDashboard = ({ user, onLogout }) => {
       return;
     }
 
+    // One key per coupon request: a double click or a retry after an error reuses it
+    if (!createKey.current || createKey.current.shopkeeper !== selectedShopkeeper) {
+      createKey.current = { shopkeeper: selectedShopkeeper, key: newIdempotencyKey() };
+    }
     setLoading(true);
     try {
       await axios.post(`${API}/customer/coupon`, {
         shopkeeper_id: selectedShopkeeper
+      }, {
+        headers: { "Idempotency-Key": createKey.current.key }
       });
+      createKey.current = null;
       toast.success("Coupon created successfully!");
       fetchCoupons();
       setSelectedShopkeeper("");
@@ -83,7 +92,7 @@ const CustomerDashboard = ({ user, onLogout }) => {
   };
 
   const handleCopyLink = async (coupon) => {
-    const link = `${window.location.origin}/#/coupon/${coupon.coupon_code}`;
+    const link = couponShareLink(API, coupon.shopkeeper_id, coupon.coupon_code);
     
     try {
       await navigator.clipboard.writeText(link);
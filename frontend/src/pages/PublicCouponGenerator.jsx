@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from "react";
+import React, { useState, useEffect, useRef } from "react";
 import { useLocation, useNavigate } from "react-router-dom";
 import axios from "axios";
 import { Button } from "@/components/ui/button";
@@ -7,6 +7,7 @@ import { Badge } from "@/components/ui/badge";
 import { Share2, Gift, CheckCircle, Clock, QrCode } from "lucide-react";
 import { toast } from "sonner";
 import { Dialog, DialogContent, DialogDescription, DialogHeader, DialogTitle } from "@/components/ui/dialog";
+import { couponShareLink, newIdempotencyKey } from "@/lib/utils";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
@@ -20,6 +21,7 @@ const PublicCouponGenerator = () => {
   const [redeemEnabled, setRedeemEnabled] = useState(false);
   const [shopInfo, setShopInfo] = useState(null);
   const [shareClicked, setShareClicked] = useState(false);
+  const generateKey = useRef(null);
 
   // Check if share was previously clicked (from localStorage)
   useEffect(() => {
@@ -101,8 +103,14 @@ const PublicCouponGenerator = () => {
   const autoGenerateCoupon = async (id) => {
     setLoading(true);
     try {
+      // Reused while the same QR link is open, so a repeated effect doesn't create a second coupon
+      if (!generateKey.current || generateKey.current.location !== location.key) {
+        generateKey.current = { location: location.key, key: newIdempotencyKey() };
+      }
       const response = await axios.post(`${API}/public/generate-coupon`, {
         shopkeeper_id: id
+      }, {
+        headers: { "Idempotency-Key": generateKey.current.key }
       });
       setCoupon(response.data);
       setShareClicked(response.data.share_clicked || false);
@@ -115,7 +123,7 @@ const PublicCouponGenerator = () => {
   const handleWhatsAppShare = async () => {
     if (!coupon) return;
 
-    const link = `${window.location.origin}/#/coupon/${coupon.coupon_code}`;
+    const link = couponShareLink(API, shopkeeperId, coupon.coupon_code);
     
     // Try to copy link to clipboard (optional)
     try {
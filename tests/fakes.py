@@ -0,0 +1,139 @@
+"""In-memory stand-ins for the few Motor collection methods the unit tests exercise"""
+
+import copy
+import itertools
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+OPERATORS = {
+    "$gt": lambda field, value: field is not None and field > value,
+    "$lte": lambda field, value: field is not None and field <= value,
+    "$in": lambda field, value: field in value,
+}
+
+
+def matches(document, query):
+    for field, value in query.items():
+        if field == "$or":
+            if not any(matches(document, branch) for branch in value):
+                return False
+        elif isinstance(value, dict) and value and all(op.startswith("$") for op in value):
+            for op, operand in value.items():
+                if op == "$exists":
+                    if (field in document) != operand:
+                        return False
+                elif not OPERATORS[op](document.get(field), operand):
+                    return False
+        elif document.get(field) != value:
+            return False
+    return True
+
+
+def project(document, projection):
+    """Inclusion or exclusion projections on top-level fields"""
+    document = copy.deepcopy(document)
+    if not projection:
+        return document
+    included = [field for field, keep in projection.items() if keep and field != "_id"]
+    if included:
+        document = {field: document[field] for field in included + ["_id"] if field in document}
+    for field, keep in projection.items():
+        if not keep:
+            document.pop(field, None)
+    return document
+
+
+class FakeCursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def sort(self, key, direction=1):
+        self.documents.sort(key=lambda document: document.get(key), reverse=direction < 0)
+        return self
+
+    def limit(self, count):
+        if count:
+            self.documents = self.documents[:count]
+        return self
+
+    async def to_list(self, length=None):
+        return self.documents[:length] if length else self.documents
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self.documents:
+            yield document
+
+
+class FakeCollection:
+    """Equality, $or/$gt/$lte/$in/$exists filters, $set/$unset/$inc updates (one at a time or as UpdateOne
+    bulk writes) and unique _id, nothing more"""
+
+    ids = itertools.count()
+
+    def __init__(self):
+        self.documents = {}
+
+    async def insert_one(self, document):
+        # Like Motor, an _id is added to the caller's document
+        document.setdefault("_id", next(self.ids))
+        if document["_id"] in self.documents:
+            raise DuplicateKeyError("duplicate _id")
+        self.documents[document["_id"]] = copy.deepcopy(document)
+
+    async def find_one(self, query, projection=None):
+        for document in self.documents.values():
+            if matches(document, query):
+                return project(document, projection)
+        return None
+
+    def find(self, query=None, projection=None):
+        return FakeCursor([
+            project(document, projection) for document in self.documents.values() if matches(document, query or {})
+        ])
+
+    def _apply(self, document, update):
+        for field, value in update.get("$set", {}).items():
+            document[field] = copy.deepcopy(value)
+        for field in update.get("$unset", {}):
+            document.pop(field, None)
+        for field, value in update.get("$inc", {}).items():
+            document[field] = document.get(field, 0) + value
+
+    async def find_one_and_update(self, query, update, sort=None, return_document=ReturnDocument.BEFORE):
+        candidates = [document for document in self.documents.values() if matches(document, query)]
+        for key, direction in reversed(sort or []):
+            candidates.sort(key=lambda document: document.get(key), reverse=direction < 0)
+        if not candidates:
+            return None
+        before = copy.deepcopy(candidates[0])
+        self._apply(candidates[0], update)
+        return copy.deepcopy(candidates[0]) if return_document == ReturnDocument.AFTER else before
+
+    async def update_one(self, query, update, upsert=False):
+        for document in self.documents.values():
+            if matches(document, query):
+                self._apply(document, update)
+                return
+
+    async def bulk_write(self, requests, ordered=True):
+        # UpdateOne keeps its filter and update in private attributes
+        for request in requests:
+            await self.update_one(request._filter, request._doc)
+
+    async def delete_one(self, query):
+        for key, document in list(self.documents.items()):
+            if matches(document, query):
+                del self.documents[key]
+                return
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.collections = {}
+
+    def __getattr__(self, name):
+        return self.collections.setdefault(name, FakeCollection())
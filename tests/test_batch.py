@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+from fastapi.security import HTTPAuthorizationCredentials
+from starlette.requests import Request
+
+import server
+from server import BatchOperation, BatchRequest, MemoryRateLimitBackend, create_access_token, run_batch
+from tests.fakes import FakeDatabase
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(server, "db", database)
+    monkeypatch.setattr(server, "rate_limit_backend", MemoryRateLimitBackend())
+    monkeypatch.setattr(server, "coupon_code_filter", server.CouponCodeFilter())
+    monkeypatch.setattr(server, "missing_coupon_cache", server.TTLCache("missing", ttl_seconds=30))
+    monkeypatch.setattr(server, "profile_cache", server.TTLCache("profiles"))
+    monkeypatch.setattr(server, "token_verifier", server.TokenVerifier())
+    database.shopkeeper_profiles.documents[1] = {
+        "_id": 1, "shopkeeper_id": "store-1", "store_name": "Corner Shop", "cashback_offer": "5%",
+    }
+    add_coupon(database, "FRESH")
+    add_coupon(database, "USED", is_redeemed=True, click_count=3)
+    database.coupons_archive.documents["OLD"] = {
+        "_id": "OLD", "coupon_code": "OLD", "shopkeeper_id": "store-1", "customer_id": "customer-1",
+        "is_redeemed": True, "click_count": 3,
+    }
+    return database
+
+
+def add_coupon(database, code, is_redeemed=False, click_count=0, customer_id="customer-1"):
+    database.coupons.documents[code] = {
+        "_id": code, "coupon_code": code, "shopkeeper_id": "store-1", "customer_id": customer_id,
+        "is_redeemed": is_redeemed, "click_count": click_count, "share_clicked": False,
+    }
+
+
+def batch(*operations, user_id=None, role="customer"):
+    request = Request({"type": "http", "method": "POST", "path": "/api/batch", "headers": [],
+                       "client": ("203.0.113.7", 1234)})
+    credentials = None
+    if user_id:
+        raw = create_access_token({"sub": user_id, "role": role, "username": user_id, "ver": 0})
+        credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=raw)
+    body = BatchRequest(operations=[BatchOperation(op=op, coupon_code=code) for op, code in operations])
+    return asyncio.run(run_batch(body, request, credentials))["results"]
+
+
+def test_each_operation_gets_its_own_result(fake_db):
+    results = batch(("coupon", "FRESH"), ("coupon", "NOPE"), ("coupon", "OLD"), ("refund", "FRESH"))
+    assert [result["status"] for result in results] == [200, 404, 200, 400]
+    assert results[0]["body"]["store_name"] == "Corner Shop"
+    assert results[2]["body"]["is_redeemed"] is True
+    assert results[3]["detail"] == "Unknown operation: refund"
+
+
+def test_missing_codes_are_remembered(fake_db):
+    batch(("coupon", "NOPE"))
+    assert server.missing_coupon_cache.get("NOPE") is True
+
+
+def test_shares_are_written_in_one_bulk_update(fake_db):
+    results = batch(("share", "FRESH"), ("share", "USED"), ("share", "NOPE"))
+    assert [result["status"] for result in results] == [200, 200, 404]
+    assert results[1]["body"]["already_redeemed"]
+    assert fake_db.coupons.documents["FRESH"]["share_clicked"] is True
+    assert fake_db.coupons.documents["USED"]["share_clicked"] is False
+
+
+def test_clicks_in_one_batch_add_up(fake_db):
+    results = batch(("click", "FRESH"), ("click", "FRESH"), ("click", "FRESH"), user_id="customer-1")
+    assert [result["body"]["click_count"] for result in results] == [1, 2, 3]
+    assert [result["body"]["can_redeem"] for result in results] == [False, False, True]
+    assert fake_db.coupons.documents["FRESH"]["click_count"] == 3
+
+
+def test_clicks_need_the_owning_customer(fake_db):
+    assert batch(("click", "FRESH"))[0]["status"] == 401
+    assert batch(("click", "FRESH"), user_id="store-1", role="shopkeeper")[0]["status"] == 403
+    assert batch(("click", "FRESH"), user_id="customer-2")[0]["status"] == 404
+    assert fake_db.coupons.documents["FRESH"]["click_count"] == 0
+
+
+def test_failed_operations_do_not_fail_the_batch(fake_db):
+    results = batch(("click", "FRESH"), ("share", "FRESH"), ("coupon", "FRESH"))
+    assert [result["status"] for result in results] == [401, 200, 200]
+    assert fake_db.coupons.documents["FRESH"]["share_clicked"] is True
+
+
+def test_share_rate_limit_applies_per_operation(fake_db, monkeypatch):
+    monkeypatch.setenv("RATE_LIMIT_TRACK_SHARE_COUPON", "2/minute")
+    results = batch(("share", "FRESH"), ("share", "FRESH"), ("share", "FRESH"))
+    assert [result["status"] for result in results] == [200, 200, 429]
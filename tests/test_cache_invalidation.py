@@ -0,0 +1,53 @@
+from server import CACHE_MISS, CacheInvalidator, TTLCache
+
+
+def make_invalidator():
+    invalidator = CacheInvalidator()
+    by_code = TTLCache("by_code")
+    everything = TTLCache("everything")
+    invalidator.subscribe("coupons", by_code, "coupon_code", clear_on_delete=False)
+    invalidator.subscribe("coupons", everything)
+    for cache in (by_code, everything):
+        cache.set("ABC", 1)
+        cache.set("XYZ", 2)
+    return invalidator, by_code, everything
+
+
+def test_keyed_change_invalidates_one_entry():
+    invalidator, by_code, everything = make_invalidator()
+    invalidator.publish("coupons", {"coupon_code": "ABC"})
+    assert by_code.get("ABC") is CACHE_MISS
+    assert by_code.get("XYZ") == 2
+    assert everything.get("XYZ") is CACHE_MISS
+
+
+def test_delete_event_keeps_caches_that_opt_out():
+    invalidator, by_code, everything = make_invalidator()
+    invalidator.publish("coupons", None, deleted=True)
+    assert by_code.get("ABC") == 1
+    assert everything.get("ABC") is CACHE_MISS
+
+
+def test_change_without_document_clears_everything():
+    invalidator, by_code, everything = make_invalidator()
+    invalidator.publish("coupons", None)
+    assert by_code.get("ABC") is CACHE_MISS
+    assert everything.get("ABC") is CACHE_MISS
+
+
+def test_invalidated_values_stay_available_for_degraded_mode():
+    invalidator, by_code, _ = make_invalidator()
+    invalidator.publish("coupons", {"coupon_code": "ABC"})
+    assert by_code.last_known("ABC") == 1
+
+
+def test_retired_values_are_held_to_the_byte_budget():
+    cache = TTLCache("images", max_bytes=1000)
+    for key in range(10):
+        cache.set(key, "x" * 400)
+        cache.invalidate(key)
+    assert cache.entries == {}
+    assert cache.retired_bytes <= 1000
+    assert list(cache.retired) == [8, 9]
+    assert cache.last_known(0) is None
+    assert cache.last_known(9) == "x" * 400
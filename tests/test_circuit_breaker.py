@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+from pymongo.errors import ServerSelectionTimeoutError
+from starlette.requests import Request
+
+import server
+from server import CircuitBreaker, DatabaseUnavailable, MongoUsageListener, guard_database
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(server.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(server, "BREAKER_FAILURE_THRESHOLD", 3)
+    monkeypatch.setattr(server, "BREAKER_WINDOW_SECONDS", 10)
+    monkeypatch.setattr(server, "BREAKER_RESET_SECONDS", 15)
+    breaker = CircuitBreaker()
+    breaker.now = now
+    monkeypatch.setattr(server, "circuit_breaker", breaker)
+    return breaker
+
+
+def open_breaker(breaker):
+    for _ in range(3):
+        breaker.record_failure()
+    assert breaker.state == "open"
+
+
+def make_request(method="GET"):
+    return Request({"type": "http", "method": method, "path": "/api/x", "headers": []})
+
+
+async def guarded(reach=False, error=None):
+    """One request through the guard_database dependency"""
+    dependency = guard_database(make_request())
+    await dependency.__anext__()
+    if reach:
+        MongoUsageListener().started(None)
+    if error is None:
+        with pytest.raises(StopAsyncIteration):
+            await dependency.__anext__()
+    else:
+        with pytest.raises(type(error)):
+            await dependency.athrow(error)
+
+
+def test_opens_after_threshold_failures_in_window(breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.snapshot()["rejected_requests"] == 1
+
+
+def test_failures_outside_window_are_forgotten(breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.now[0] += 11
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+
+def test_half_open_lets_a_single_trial_through(breaker):
+    open_breaker(breaker)
+    assert breaker.retry_after() == 15
+    breaker.now[0] += 15
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()
+
+
+def test_trial_success_closes_and_failure_reopens(breaker):
+    open_breaker(breaker)
+    breaker.now[0] += 15
+    breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.times_opened == 2
+    breaker.now[0] += 15
+    breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def test_guard_rejects_while_open(breaker):
+    open_breaker(breaker)
+    with pytest.raises(DatabaseUnavailable):
+        asyncio.run(guarded())
+
+
+def test_guard_counts_requests_that_reached_mongo(breaker):
+    open_breaker(breaker)
+    breaker.now[0] += 15
+    asyncio.run(guarded(reach=True))
+    assert breaker.state == "closed"
+
+
+def test_guard_cache_hit_does_not_close_half_open_breaker(breaker):
+    open_breaker(breaker)
+    breaker.now[0] += 15
+    asyncio.run(guarded())
+    assert breaker.state == "half_open"
+    # The trial is handed back rather than left in flight forever
+    assert breaker.allow()
+
+
+def test_guard_records_mongo_errors(breaker):
+    for _ in range(3):
+        asyncio.run(guarded(reach=True, error=ServerSelectionTimeoutError("down")))
+    assert breaker.state == "open"
+
+
+def test_guard_ignores_other_errors(breaker):
+    open_breaker(breaker)
+    breaker.now[0] += 15
+    asyncio.run(guarded(reach=True, error=ValueError("bad input")))
+    assert breaker.state == "closed"
+
+
+def test_listener_ignores_commands_outside_requests():
+    MongoUsageListener().started(None)
+    assert server.request_mongo_usage.get() is None
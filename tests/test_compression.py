@@ -0,0 +1,132 @@
+import asyncio
+import gzip
+import json
+
+import pytest
+from starlette.requests import Request
+
+import server
+from server import (
+    CompressionMiddleware, PrefixedSnapshot, Snapshot, TTLCache, brotli, negotiate_encoding,
+)
+
+
+def make_request(accept_encoding):
+    headers = [(b"accept-encoding", accept_encoding.encode())] if accept_encoding is not None else []
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": headers})
+
+
+def run_middleware(chunks, accept_encoding="gzip", content_type=b"application/json"):
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", content_type)]})
+        for i, chunk in enumerate(chunks):
+            await send({"type": "http.response.body", "body": chunk, "more_body": i < len(chunks) - 1})
+
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": "/", "headers": [(b"accept-encoding", accept_encoding.encode())]}
+    asyncio.run(CompressionMiddleware(app)(scope, None, send))
+    headers = dict(messages[0]["headers"])
+    return headers, [m["body"] for m in messages[1:]]
+
+
+def test_negotiate_encoding_prefers_offered_order():
+    assert negotiate_encoding("gzip, deflate") == "gzip"
+    assert negotiate_encoding("br;q=0, gzip;q=0") == "identity"
+    assert negotiate_encoding("*") == ("br" if brotli else "gzip")
+    assert negotiate_encoding("br, gzip", offered=("gzip",)) == "gzip"
+    assert negotiate_encoding("br", offered=("gzip",)) == "identity"
+
+
+def test_snapshot_serializes_once_and_compresses_lazily():
+    snapshot = Snapshot({"items": ["x" * 50] * 100})
+    assert list(snapshot.encodings) == ["identity"]
+    assert json.loads(gzip.decompress(snapshot.body("gzip"))) == {"items": ["x" * 50] * 100}
+    assert snapshot.body("gzip") is snapshot.body("gzip")
+
+
+def test_snapshot_response_skips_small_bodies():
+    response = Snapshot({"a": 1}).response(make_request("gzip"))
+    assert "content-encoding" not in response.headers
+    assert response.headers["vary"] == "Accept-Encoding"
+
+
+@pytest.mark.parametrize("fields", [{"coupon_code": "ABC123", "is_redeemed": False}, {"n": "é" * 3000}])
+def test_prefixed_snapshot_splices_gzip(fields):
+    store = Snapshot({"store_name": "Corner", "promotional_image": "data:image/jpeg;base64," + "QUJD" * 5000})
+    prefixed = PrefixedSnapshot(fields, store)
+    expected = {**fields, **json.loads(store.body())}
+    assert json.loads(prefixed.body()) == expected
+    assert len(prefixed) == len(prefixed.body())
+    assert json.loads(gzip.decompress(prefixed.body("gzip"))) == expected
+    # The store part is deflated once and shared by every coupon
+    assert store.encodings["deflate-tail"] is store.deflated_tail()
+
+
+def test_prefixed_snapshot_never_offers_brotli():
+    store = Snapshot({"store_name": "x" * 5000})
+    response = PrefixedSnapshot({"coupon_code": "A"}, store).response(make_request("br, gzip"))
+    assert response.headers["content-encoding"] == "gzip"
+    assert json.loads(gzip.decompress(response.body))["coupon_code"] == "A"
+    assert PrefixedSnapshot({"coupon_code": "A"}, store).response(make_request("br")).headers.get("content-encoding") is None
+
+
+def test_cache_evicts_oldest_to_stay_within_byte_budget():
+    cache = TTLCache("test", max_bytes=10000)
+    for key in range(5):
+        cache.set(key, "x" * 3000)
+    assert cache.bytes <= 10000
+    assert list(cache.entries) == [2, 3, 4]
+    # Evicted values stay available to last_known for degraded mode
+    assert cache.last_known(0) == "x" * 3000
+
+
+def test_cache_skips_values_over_budget_and_replaces_in_place():
+    cache = TTLCache("test", max_bytes=1000)
+    cache.set("big", "x" * 2000)
+    assert cache.entries == {} and cache.bytes == 0
+    cache.set("a", "x" * 100)
+    cache.set("a", "x" * 200)
+    assert cache.bytes == server.approximate_size("x" * 200)
+    cache.invalidate("a")
+    assert cache.bytes == 0
+
+
+def test_cache_sizes_snapshots_by_body():
+    snapshot = Snapshot({"image": "x" * 10000})
+    assert server.approximate_size(snapshot) >= len(snapshot.body())
+
+
+def test_middleware_streams_gzip_chunks():
+    chunks = [b'{"rows":[', b'"' + b"a" * 5000 + b'",', b'"' + b"b" * 5000 + b'"', b"]}"]
+    headers, bodies = run_middleware(chunks)
+    assert headers[b"content-encoding"] == b"gzip"
+    assert b"content-length" not in headers
+    # Every chunk is flushed, so the client receives data as it's produced
+    assert all(bodies[:-1])
+    assert json.loads(gzip.decompress(b"".join(bodies))) == json.loads(b"".join(chunks))
+
+
+def test_middleware_compresses_single_body_with_length():
+    body = json.dumps({"x": "y" * 4000}).encode()
+    headers, bodies = run_middleware([body])
+    assert gzip.decompress(bodies[0]) == body
+    assert headers[b"content-length"] == str(len(bodies[0])).encode()
+
+
+def test_middleware_passes_small_and_binary_bodies_through():
+    headers, bodies = run_middleware([b'{"ok":true}'])
+    assert b"content-encoding" not in headers and bodies == [b'{"ok":true}']
+    headers, bodies = run_middleware([b"\xff" * 5000], content_type=b"image/jpeg")
+    assert b"content-encoding" not in headers
+
+
+@pytest.mark.skipif(brotli is None, reason="brotli not installed")
+def test_middleware_streams_brotli():
+    chunks = [b"[" + b'"row",' * 2000, b'"end"]']
+    headers, bodies = run_middleware(chunks, accept_encoding="br")
+    assert headers[b"content-encoding"] == b"br"
+    assert brotli.decompress(b"".join(bodies)) == b"".join(chunks)
@@ -0,0 +1,108 @@
+import time
+import uuid
+
+import pytest
+
+import server
+from server import BloomFilter, CouponCodeFilter, coupon_code_missing
+
+
+def random_codes(count):
+    return [uuid.uuid4().hex[:8].upper() for _ in range(count)]
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(10000, 0.01)
+    codes = random_codes(10000)
+    for code in codes:
+        bloom.add(code)
+    assert all(code in bloom for code in codes)
+    assert bloom.count == 10000
+
+
+@pytest.mark.parametrize("rate", [0.01, 0.001])
+def test_bloom_filter_false_positive_rate_near_target(rate):
+    bloom = BloomFilter(20000, rate)
+    for code in random_codes(20000):
+        bloom.add(code)
+    # Codes of a different length can't collide with the ones added
+    probes = [uuid.uuid4().hex for _ in range(50000)]
+    observed = sum(probe in bloom for probe in probes) / len(probes)
+    assert observed < rate * 2
+
+
+def test_bloom_filter_sizing():
+    bloom = BloomFilter(100000, 0.01)
+    # ~9.6 bits and 7 hashes per element for 1%
+    assert 115000 <= len(bloom.bits) <= 125000
+    assert bloom.hashes == 7
+
+
+@pytest.fixture
+def code_filter(monkeypatch):
+    invalidator = server.CacheInvalidator()
+    invalidator.live = True
+    invalidator.epoch = 3
+    invalidator.synced_at = time.time()
+    monkeypatch.setattr(server, "cache_invalidator", invalidator)
+    code_filter = CouponCodeFilter()
+    code_filter.filter = BloomFilter(1000, 0.01)
+    code_filter.epoch = 3
+    code_filter.add("KNOWN")
+    monkeypatch.setattr(server, "coupon_code_filter", code_filter)
+    monkeypatch.setattr(server, "missing_coupon_cache", server.TTLCache("missing", ttl_seconds=30))
+    return code_filter
+
+
+def test_filter_rejects_unknown_codes_while_trusted(code_filter):
+    assert not code_filter.definitely_missing("KNOWN")
+    assert code_filter.definitely_missing("UNKNOWN")
+    assert code_filter.snapshot()["rejected_lookups"] == 1
+    assert code_filter.snapshot()["trusted"]
+
+
+def test_filter_untrusted_when_stream_down(code_filter):
+    server.cache_invalidator.live = False
+    assert not code_filter.definitely_missing("UNKNOWN")
+    assert not code_filter.snapshot()["trusted"]
+
+
+def test_filter_untrusted_while_stream_lags(code_filter):
+    # A code inserted by another worker may still be queued behind older events
+    server.cache_invalidator.synced_at = time.time() - server.CHANGE_STREAM_MAX_LAG_SECONDS - 1
+    assert not code_filter.definitely_missing("UNKNOWN")
+    assert not code_filter.snapshot()["trusted"]
+    server.cache_invalidator.synced_at = time.time()
+    assert code_filter.definitely_missing("UNKNOWN")
+
+
+def test_filter_untrusted_after_reconnect_until_rebuilt(code_filter):
+    # Inserts from other workers may have been missed while the stream was reconnecting
+    server.cache_invalidator.epoch += 1
+    assert not code_filter.definitely_missing("UNKNOWN")
+    code_filter.epoch = server.cache_invalidator.epoch
+    assert code_filter.definitely_missing("UNKNOWN")
+
+
+def test_filter_untrusted_before_first_build(code_filter):
+    code_filter.filter = None
+    assert not code_filter.definitely_missing("UNKNOWN")
+
+
+def test_codes_added_during_rebuild_reach_both_filters(code_filter):
+    code_filter.building = BloomFilter(1000, 0.01)
+    code_filter.add("NEW")
+    assert "NEW" in code_filter.filter and "NEW" in code_filter.building
+
+
+def test_writes_only_trust_the_negative_cache(code_filter):
+    assert coupon_code_missing("UNKNOWN")
+    assert not coupon_code_missing("UNKNOWN", trust_filter=False)
+    server.missing_coupon_cache.set("UNKNOWN", True)
+    assert coupon_code_missing("UNKNOWN", trust_filter=False)
+
+
+def test_remembered_code_clears_negative_cache(code_filter):
+    server.missing_coupon_cache.set("FRESH", True)
+    server.remember_coupon_code("FRESH")
+    assert not coupon_code_missing("FRESH")
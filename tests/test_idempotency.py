@@ -0,0 +1,124 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+
+import pymongo
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import run_idempotent
+from tests.fakes import FakeDatabase
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(server, "db", database)
+    monkeypatch.setattr(server, "idempotency_flight", server.SingleFlight())
+    return database
+
+
+def counting(response):
+    calls = []
+
+    async def create():
+        calls.append(1)
+        return response
+
+    return create, calls
+
+
+def pending(database, key, fingerprint, locked_for):
+    now = datetime.now(timezone.utc)
+    database.idempotency_keys.documents[key] = {
+        "_id": key, "fingerprint": fingerprint, "status": "pending", "lease": "other-worker",
+        "locked_until": now + timedelta(seconds=locked_for), "expires_at": now + timedelta(hours=1),
+    }
+
+
+def test_retry_replays_the_first_response(fake_db):
+    create, calls = counting({"coupon_code": "ABC"})
+    first = asyncio.run(run_idempotent("generate-coupon", "k1", "store-1", create))
+    again = asyncio.run(run_idempotent("generate-coupon", "k1", "store-1", create))
+    assert first == again == {"coupon_code": "ABC"}
+    assert calls == [1]
+    stored = fake_db.idempotency_keys.documents["generate-coupon:k1"]
+    assert stored["status"] == "done" and "locked_until" not in stored
+
+
+def test_missing_key_always_runs(fake_db):
+    create, calls = counting({})
+    asyncio.run(run_idempotent("generate-coupon", None, "store-1", create))
+    asyncio.run(run_idempotent("generate-coupon", None, "store-1", create))
+    assert calls == [1, 1]
+
+
+def test_key_reused_for_another_request_is_rejected(fake_db):
+    create, _ = counting({})
+    asyncio.run(run_idempotent("generate-coupon", "k1", "store-1", create))
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(run_idempotent("generate-coupon", "k1", "store-2", create))
+    assert exc.value.status_code == 422
+
+
+def test_failure_releases_the_key(fake_db):
+    async def fail():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(run_idempotent("generate-coupon", "k1", "store-1", fail))
+    assert fake_db.idempotency_keys.documents == {}
+
+
+def test_expired_lease_is_taken_over(fake_db):
+    pending(fake_db, "generate-coupon:k1", "store-1", locked_for=-1)
+    create, calls = counting({"coupon_code": "NEW"})
+    assert asyncio.run(run_idempotent("generate-coupon", "k1", "store-1", create)) == {"coupon_code": "NEW"}
+    assert calls == [1]
+    stored = fake_db.idempotency_keys.documents["generate-coupon:k1"]
+    assert stored["status"] == "done" and stored["lease"] != "other-worker"
+
+
+def test_late_holder_cannot_clobber_a_takeover(fake_db):
+    documents = fake_db.idempotency_keys.documents
+
+    async def slow_then_fail():
+        # Another request took the key over while this one was stuck
+        documents["generate-coupon:k1"]["lease"] = "theirs"
+        raise RuntimeError("timed out")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(run_idempotent("generate-coupon", "k1", "store-1", slow_then_fail))
+    assert documents["generate-coupon:k1"]["lease"] == "theirs"
+
+    async def slow_then_succeed():
+        documents["generate-coupon:k2"]["lease"] = "theirs"
+        return {"coupon_code": "LATE"}
+
+    asyncio.run(run_idempotent("generate-coupon", "k2", "store-1", slow_then_succeed))
+    assert documents["generate-coupon:k2"]["status"] == "pending"
+
+
+def test_live_lease_answers_409_before_the_mongo_deadline(fake_db, monkeypatch):
+    pending(fake_db, "generate-coupon:k1", "store-1", locked_for=60)
+    create, calls = counting({})
+    started = time.monotonic()
+    with pymongo.timeout(1):
+        with pytest.raises(HTTPException) as exc:
+            asyncio.run(run_idempotent("generate-coupon", "k1", "store-1", create))
+    assert exc.value.status_code == 409
+    assert time.monotonic() - started < 1 - server.IDEMPOTENCY_DEADLINE_MARGIN_SECONDS + 0.2
+    assert calls == []
+
+
+def test_lease_expiring_during_the_wait_is_taken_over(fake_db):
+    pending(fake_db, "generate-coupon:k1", "store-1", locked_for=0.3)
+    create, calls = counting({"coupon_code": "NEW"})
+    with pymongo.timeout(server.MONGO_WRITE_TIMEOUT_SECONDS):
+        assert asyncio.run(run_idempotent("generate-coupon", "k1", "store-1", create)) == {"coupon_code": "NEW"}
+    assert calls == [1]
+
+
+def test_lease_is_shorter_than_the_write_deadline():
+    assert server.IDEMPOTENCY_LEASE_SECONDS < server.MONGO_WRITE_TIMEOUT_SECONDS - server.IDEMPOTENCY_DEADLINE_MARGIN_SECONDS
@@ -0,0 +1,153 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+from server import JobQueue
+from tests.fakes import FakeDatabase
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(server, "db", database)
+    monkeypatch.setattr(server, "job_handlers", {})
+    monkeypatch.setattr(server, "JOB_MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(server, "JOB_RETRY_BASE_SECONDS", 2)
+    return database
+
+
+def handler(name, fail_times=0):
+    calls = []
+
+    async def handle(payload):
+        calls.append(payload)
+        if len(calls) <= fail_times:
+            raise RuntimeError("downstream unavailable")
+
+    server.job_handlers[name] = handle
+    return calls
+
+
+def outbox(database):
+    return list(database.job_outbox.documents.values())
+
+
+def leased_for(job):
+    return (job["locked_until"] - datetime.now(timezone.utc)).total_seconds()
+
+
+def test_enqueue_writes_the_outbox_before_queueing(fake_db):
+    queue = JobQueue()
+    job_id = asyncio.run(queue.enqueue("notify", {"n": 1}))
+    [stored] = outbox(fake_db)
+    assert stored["id"] == job_id and stored["status"] == "pending" and stored["attempts"] == 0
+    # Leased to this process, so the poller leaves it alone
+    assert leased_for(stored) == pytest.approx(server.JOB_LEASE_SECONDS, abs=5)
+    assert queue.queue.get_nowait()["id"] == job_id
+
+
+def test_successful_job_leaves_the_outbox(fake_db):
+    calls = handler("notify")
+    queue = JobQueue()
+
+    async def scenario():
+        await queue.enqueue("notify", {"n": 1})
+        await queue.run(queue.queue.get_nowait())
+
+    asyncio.run(scenario())
+    assert calls == [{"n": 1}]
+    assert outbox(fake_db) == []
+    assert queue.snapshot()["completed"] == 1
+
+
+def test_failure_backs_off_exponentially(fake_db):
+    handler("notify", fail_times=2)
+    queue = JobQueue()
+
+    async def attempt(job):
+        await queue.run(job)
+        return await fake_db.job_outbox.find_one({"id": job["id"]})
+
+    async def scenario():
+        await queue.enqueue("notify", {})
+        job = await attempt(queue.queue.get_nowait())
+        assert job["attempts"] == 1 and "RuntimeError" in job["error"]
+        assert leased_for(job) == pytest.approx(2, abs=1)
+        job = await attempt(job)
+        assert job["attempts"] == 2
+        assert leased_for(job) == pytest.approx(4, abs=1)
+        return await attempt(job)
+
+    assert asyncio.run(scenario()) is None
+    assert queue.snapshot()["retried"] == 2
+    assert queue.snapshot()["completed"] == 1
+
+
+def test_gives_up_after_max_attempts(fake_db):
+    calls = handler("notify", fail_times=10)
+    queue = JobQueue()
+
+    async def scenario():
+        await queue.enqueue("notify", {})
+        job = queue.queue.get_nowait()
+        for _ in range(3):
+            await queue.run(job)
+            job = await fake_db.job_outbox.find_one({"id": job["id"]})
+        return job
+
+    job = asyncio.run(scenario())
+    assert len(calls) == 3
+    assert job["status"] == "failed"
+    assert queue.snapshot()["failed"] == 1
+
+
+def test_unknown_job_is_retried_not_dropped(fake_db):
+    queue = JobQueue()
+
+    async def scenario():
+        await queue.enqueue("unregistered", {})
+        await queue.run(queue.queue.get_nowait())
+
+    asyncio.run(scenario())
+    [stored] = outbox(fake_db)
+    assert stored["attempts"] == 1 and "LookupError" in stored["error"]
+
+
+def test_claim_recovers_only_expired_leases_oldest_first(fake_db):
+    now = datetime.now(timezone.utc)
+    for _id, locked_until in (("live", now + timedelta(minutes=1)), ("newer", now - timedelta(seconds=5)),
+                              ("older", now - timedelta(minutes=5))):
+        fake_db.job_outbox.documents[_id] = {
+            "_id": _id, "id": _id, "name": "notify", "payload": {}, "status": "pending",
+            "attempts": 0, "locked_until": locked_until,
+        }
+    fake_db.job_outbox.documents["failed"] = {
+        "_id": "failed", "id": "failed", "status": "failed", "locked_until": now - timedelta(hours=1),
+    }
+    queue = JobQueue()
+
+    async def claim_all():
+        claimed = []
+        while (job := await queue.claim()) is not None:
+            claimed.append(job)
+        return claimed
+
+    claimed = asyncio.run(claim_all())
+    assert [job["id"] for job in claimed] == ["older", "newer"]
+    # Claimed jobs are leased again, so another worker's poller skips them
+    assert all(leased_for(job) > server.JOB_LEASE_SECONDS - 5 for job in claimed)
+
+
+def test_full_queue_leaves_the_job_to_the_poller(fake_db, monkeypatch):
+    monkeypatch.setattr(server, "JOB_QUEUE_SIZE", 1)
+    queue = JobQueue()
+
+    async def scenario():
+        await queue.enqueue("notify", {"n": 1})
+        await queue.enqueue("notify", {"n": 2})
+
+    asyncio.run(scenario())
+    assert queue.queue.qsize() == 1
+    assert len(outbox(fake_db)) == 2
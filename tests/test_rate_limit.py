@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import server
+from server import MemoryRateLimitBackend, enforce_rate_limit, get_client_ip, parse_rate_limit
+
+
+def make_request(peer, forwarded=None):
+    headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": headers, "client": (peer, 1234)})
+
+
+def test_parse_rate_limit_named_period():
+    assert parse_rate_limit("10/minute") == (10, 10 / 60)
+    assert parse_rate_limit("5/ hour") == (5, 5 / 3600)
+
+
+def test_parse_rate_limit_period_in_seconds():
+    assert parse_rate_limit("3/30") == (3, 0.1)
+
+
+def test_parse_rate_limit_rejects_unknown_period():
+    with pytest.raises(ValueError):
+        parse_rate_limit("10/fortnight")
+
+
+def test_memory_backend_allows_capacity_then_rejects():
+    backend = MemoryRateLimitBackend()
+    results = [asyncio.run(backend.acquire("ip:1", 3, 1.0)) for _ in range(4)]
+    assert [allowed for allowed, _ in results] == [True, True, True, False]
+    assert results[-1][1] == pytest.approx(1.0, abs=0.05)
+
+
+def test_memory_backend_refills_over_time(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(server.time, "monotonic", lambda: now[0])
+    backend = MemoryRateLimitBackend()
+    for _ in range(2):
+        asyncio.run(backend.acquire("ip:1", 2, 0.5))
+    assert asyncio.run(backend.acquire("ip:1", 2, 0.5)) == (False, 2.0)
+    now[0] += 2
+    assert asyncio.run(backend.acquire("ip:1", 2, 0.5))[0]
+
+
+def test_memory_backend_keys_are_independent():
+    backend = MemoryRateLimitBackend()
+    assert asyncio.run(backend.acquire("ip:1", 1, 1.0))[0]
+    assert asyncio.run(backend.acquire("ip:2", 1, 1.0))[0]
+    assert not asyncio.run(backend.acquire("ip:1", 1, 1.0))[0]
+
+
+def test_memory_backend_evicts_stalest_bucket():
+    backend = MemoryRateLimitBackend(max_keys=2)
+    for key in ("a", "b", "a", "c"):
+        asyncio.run(backend.acquire(key, 5, 1.0))
+    assert list(backend.buckets) == ["a", "c"]
+
+
+def test_enforce_rate_limit_raises_429_with_retry_after(monkeypatch):
+    monkeypatch.setattr(server, "rate_limit_backend", MemoryRateLimitBackend())
+    rules = {"ip": parse_rate_limit("2/minute"), "coupon": parse_rate_limit("1/minute")}
+    asyncio.run(enforce_rate_limit("redeem-coupon", rules, {"ip": "1.2.3.4"}))
+    asyncio.run(enforce_rate_limit("redeem-coupon", rules, {"ip": "1.2.3.4"}))
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(enforce_rate_limit("redeem-coupon", rules, {"ip": "1.2.3.4"}))
+    assert exc.value.status_code == 429
+    assert exc.value.headers["Retry-After"] == "30"
+
+
+def test_enforce_rate_limit_checks_every_bucket(monkeypatch):
+    monkeypatch.setattr(server, "rate_limit_backend", MemoryRateLimitBackend())
+    rules = {"ip": parse_rate_limit("10/minute"), "coupon": parse_rate_limit("1/minute")}
+    asyncio.run(enforce_rate_limit("redeem-coupon", rules, {"ip": "1.2.3.4", "coupon": "ABC"}))
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(enforce_rate_limit("redeem-coupon", rules, {"ip": "5.6.7.8", "coupon": "ABC"}))
+    assert exc.value.headers["Retry-After"] == "60"
+
+
+def test_client_ip_ignores_forwarded_header_by_default(monkeypatch):
+    monkeypatch.setattr(server, "TRUSTED_PROXIES", [])
+    monkeypatch.setattr(server, "TRUSTED_PROXY_NETWORKS", [])
+    assert get_client_ip(make_request("10.0.0.5", "203.0.113.9")) == "10.0.0.5"
+
+
+def test_client_ip_from_trusted_proxy(monkeypatch):
+    monkeypatch.setattr(server, "TRUSTED_PROXIES", ["10.0.0.0/8"])
+    monkeypatch.setattr(server, "TRUSTED_PROXY_NETWORKS", [server.ipaddress.ip_network("10.0.0.0/8")])
+    # The spoofed leftmost entry is skipped, as is the second trusted proxy hop
+    request = make_request("10.0.0.5", "198.51.100.1, 203.0.113.9, 10.0.0.7")
+    assert get_client_ip(request) == "203.0.113.9"
+    assert get_client_ip(make_request("192.0.2.4", "203.0.113.9")) == "192.0.2.4"
+
+
+def test_client_ip_trust_any_peer_takes_last_hop(monkeypatch):
+    monkeypatch.setattr(server, "TRUSTED_PROXIES", ["*"])
+    monkeypatch.setattr(server, "TRUSTED_PROXY_NETWORKS", [])
+    assert get_client_ip(make_request("10.0.0.5", "198.51.100.1, 203.0.113.9")) == "203.0.113.9"
+    assert get_client_ip(make_request("10.0.0.5")) == "10.0.0.5"
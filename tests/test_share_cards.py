@@ -0,0 +1,62 @@
+import base64
+import builtins
+import io
+
+import pytest
+
+from server import SHARE_IMAGE_SIZE, compress_share_image, render_share_meta
+
+
+def data_url(content_type, raw):
+    return f"data:{content_type};base64," + base64.b64encode(raw).decode()
+
+
+@pytest.fixture
+def without_pillow(monkeypatch):
+    real_import = builtins.__import__
+
+    def fake_import(name, *args, **kwargs):
+        if name == "PIL":
+            raise ImportError(name)
+        return real_import(name, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, "__import__", fake_import)
+
+
+def test_fallback_serves_small_raster_uploads_as_is(without_pillow):
+    raw = b"\x89PNG\r\n\x1a\n" + b"\x00" * 100
+    assert compress_share_image(data_url("image/png", raw)) == (raw, "image/png", None)
+
+
+@pytest.mark.parametrize("content_type", ["image/svg+xml", "text/html", "image/gif"])
+def test_fallback_rejects_non_raster_types(without_pillow, content_type):
+    raw = b"<svg xmlns='http://www.w3.org/2000/svg'><script>alert(1)</script></svg>"
+    assert compress_share_image(data_url(content_type, raw)) == (None, None, None)
+
+
+def test_fallback_rejects_large_uploads(without_pillow):
+    assert compress_share_image(data_url("image/jpeg", b"\xff" * (400 * 1024))) == (None, None, None)
+
+
+def test_pillow_renders_a_preview_jpeg():
+    Image = pytest.importorskip("PIL.Image")
+    out = io.BytesIO()
+    Image.new("RGB", (1200, 1600), "red").save(out, "PNG")
+    image, image_type, size = compress_share_image(data_url("image/png", out.getvalue()))
+    assert image_type == "image/jpeg" and size == SHARE_IMAGE_SIZE
+    assert Image.open(io.BytesIO(image)).size == SHARE_IMAGE_SIZE
+
+
+def test_pillow_rejects_svg():
+    pytest.importorskip("PIL")
+    assert compress_share_image(data_url("image/svg+xml", b"<svg><script/></svg>")) == (None, None, None)
+
+
+def test_unusable_data_urls():
+    assert compress_share_image(None) == (None, None, None)
+    assert compress_share_image("https://example.com/a.jpg") == (None, None, None)
+
+
+def test_share_meta_is_escaped():
+    meta = render_share_meta({"store_name": '<b>"Shop"</b>', "cashback_offer": "10%"})
+    assert "<b>" not in meta and "&lt;b&gt;&quot;Shop&quot;" in meta
@@ -0,0 +1,99 @@
+import asyncio
+import math
+from datetime import timedelta
+
+import jwt
+import pytest
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
+
+import server
+from server import TokenVerifier, create_access_token, get_current_user
+from tests.fakes import FakeDatabase
+
+
+@pytest.fixture
+def verifier(monkeypatch):
+    verifier = TokenVerifier(max_entries=2)
+    monkeypatch.setattr(server, "token_verifier", verifier)
+    return verifier
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(server, "db", database)
+    return database
+
+
+def token(user_id="user-1", version=0, lifetime=timedelta(hours=1)):
+    return create_access_token(
+        {"sub": user_id, "role": "shopkeeper", "username": "shop", "ver": version}, lifetime
+    )
+
+
+def authenticate(raw_token):
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=raw_token)
+    return asyncio.run(get_current_user(credentials))
+
+
+def test_verified_tokens_skip_the_signature_check(verifier, monkeypatch):
+    raw = token()
+    verifier.decode(raw)
+    monkeypatch.setattr(server.jwt, "decode", lambda *args, **kwargs: pytest.fail("decoded twice"))
+    assert verifier.decode(raw)["sub"] == "user-1"
+
+
+def test_cache_is_bounded(verifier):
+    raws = [token(f"user-{n}") for n in range(3)]
+    for raw in raws:
+        verifier.decode(raw)
+    assert list(verifier.verified) == raws[1:]
+
+
+def test_cached_token_still_expires(verifier, monkeypatch):
+    raw = token()
+    claims = verifier.decode(raw)
+    monkeypatch.setattr(server.time, "time", lambda: claims["exp"] + 1)
+    with pytest.raises(jwt.ExpiredSignatureError):
+        verifier.decode(raw)
+    assert raw not in verifier.verified
+
+
+def test_claims_answer_without_loading_the_user(verifier, fake_db):
+    user = authenticate(token())
+    assert (user.id, user.role, user.username) == ("user-1", "shopkeeper", "shop")
+
+
+def test_revoked_versions_are_rejected(verifier):
+    verifier.revoke("user-1", 2)
+    with pytest.raises(HTTPException) as rejected:
+        authenticate(token(version=1))
+    assert rejected.value.status_code == 401
+    assert authenticate(token(version=2)).id == "user-1"
+
+
+def test_invalid_token_is_rejected(verifier):
+    with pytest.raises(HTTPException) as rejected:
+        authenticate(token() + "x")
+    assert rejected.value.status_code == 401
+
+
+def test_refresh_loads_revoked_and_deleted_users(verifier, fake_db):
+    fake_db.users.documents.update({
+        1: {"_id": 1, "id": "current", "token_version": 0},
+        2: {"_id": 2, "id": "logged-out", "token_version": 3},
+        3: {"_id": 3, "id": "deleted", "token_version": 0, "deleted_at": "2026-01-01T00:00:00+00:00"},
+    })
+    fake_db.revoked_users.documents[4] = {"_id": 4, "id": "purged"}
+    asyncio.run(verifier.refresh())
+    assert verifier.min_versions == {"logged-out": 3, "deleted": math.inf, "purged": math.inf}
+
+
+def test_refresh_keeps_newer_local_revocations(verifier, fake_db):
+    fake_db.users.documents[1] = {"_id": 1, "id": "user-1", "token_version": 1}
+    # Revoked on this worker while the refresh query was running
+    verifier.revoke("user-1", 2)
+    verifier.revoke("user-2", math.inf)
+    asyncio.run(verifier.refresh())
+    assert verifier.min_versions == {"user-1": 2, "user-2": math.inf}